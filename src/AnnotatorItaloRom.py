@@ -24,7 +24,7 @@ sys.dont_write_bytecode = True
 from UIToolkit import *
 from model import *
 from AnnotatorWindow import *
-import logging, sys, os
+import logging, sys, os, persistentdb
 from weakref import ref
 
 
@@ -96,8 +96,11 @@ class AppController(ApplicationController):
     
     filepath = os.path.join(ref.dir.path, ref.name)
     
-    # open the document
-    document = Document(filepath)
+    # open the document (the rapid edits are written in groups, at least every second, the document
+    # stops the task when it is closed)
+    # it is shared, so that tools/snapshot_documents.py can back it up while it is open
+    document = Document(filepath, policy = persistentdb.GroupCommitPolicy, shared = True)
+    document.flushTask = Task(document.database.flush, persistentdb.GroupCommitPolicy.commit_window, repeat = True)
     
     # create the window for the document
     window = Window(controller = AnnotatorWindowController(document))
@@ -46,6 +46,7 @@ class AnnotatorWindowController(WindowController):
     spanContainer = UI.SimpleLayoutContainer(position = (25, 50), controller = self)
     self.containerView = spanContainer
     self.window.contents.addView(spanContainer)
+    prefetched = self.document.prefetch()
     self.spanControllers = [SpanController(span, self) for span in self.document.spans]
     self.window.layoutInProgress = False
     
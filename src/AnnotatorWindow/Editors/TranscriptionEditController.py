@@ -26,6 +26,8 @@ from UIToolkit.UI.Editors import EditorOperationError
 class TranscriptionEditController(UI.Editors.EditController):
   def __init__(self, tokenController):
     self.tokenController = tokenController
+    # the edit continues the active transaction (e.g. the one of the token that was split), the 
+    # operations that change several objects are done in savepoints of it
     self.transaction = self.token.__db__.activeTransaction
     if self.transaction is None:
       self.transaction = self.token.__db__.transaction()
@@ -77,16 +79,23 @@ class TranscriptionEditController(UI.Editors.EditController):
         return(len(p0))
       
       
-      # set the token to the value
-      self.value = p0
+      # split the token: if adding the new token fails, only the split is rolled back
+      savepoint = self.transaction.savepoint()
+      try:
+        with savepoint:
+          # set the token to the value
+          self.token.transcription = p0
+          
+          #  add the new token
+          span = self.spanController.representedObject
+          new_token = span.__db__.document.persistenceSchema.classes.Token(p1)
+          span.addToken(new_token, after = self.token)
+      except Exception:
+        logging.exception("Could not split the token")
+        return position
+      savepoint.commit()
       
-      #  add the new token
-      with self.transaction:
-        span = self.spanController.representedObject
-        new_token = span.__db__.document.persistenceSchema.classes.Token(p1)
-        span.addToken(new_token, after = self.token)
-      
-      # remove the current transaction
+      # the edit controller of the new token takes the transaction over
       self.transaction = None
         
       # give control to the new edit window
@@ -142,15 +151,16 @@ class TranscriptionEditController(UI.Editors.EditController):
     if len(value) == 0:
       # delete the token
       window = self.editor.window
-      refmark = self.token.refmark
       
-      with self.transaction:
-        try:
+      # if the token can't be removed, the savepoint restores its reference mark
+      savepoint = self.transaction.savepoint()
+      try:
+        with savepoint:
           self.token.refmark = None  
           self.spanController.representedObject.removeToken(self.token)
-        except ValueError:
-          self.token.refmark = refmark
-          return position
+      except ValueError:
+        return position
+      savepoint.commit()
       
       window.firstResponder = None    
       return 0
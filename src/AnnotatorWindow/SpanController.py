@@ -68,8 +68,11 @@ class SpanController(ViewController):
     for obj in set(self.__controllerMap.keys()) - span_objects:
       del self.__controllerMap[obj]
       
-    # which view state objects should we add?
-    for obj in span_objects - set(self.__controllerMap.keys()):
+    # which view state objects should we add? (they are loaded at once, before the controllers read them)
+    added_objects = span_objects - set(self.__controllerMap.keys())
+    self.representedObject.__db__.materialize(added_objects)
+
+    for obj in added_objects:
       if isinstance(obj, model.Token):
        controller = TokenController(obj, self)
       elif isinstance(obj, model.Constituent):
@@ -65,8 +65,8 @@ class TokenController(ViewController):
     
   # ---- new annotation creation
   def createDependencyAnnotation(self, sender):
-    # create a new dependency relation
-    transaction = transaction = self.representedObject.__db__.transaction()
+    # create a new dependency relation (in a savepoint if an edit is already underway)
+    transaction = self.representedObject.__db__.savepoint()
     document = self.representedObject.__db__.document
     with transaction:
       dependency = document.persistenceSchema.classes.DependencyRelation(self.representedObject, self.representedObject)
@@ -75,6 +75,13 @@ class TokenController(ViewController):
     depController = self.spanController.getControllerForObject(dependency)
     safecall(depController).edit('target')
     
+    # the editor takes the active transaction over and commits or aborts it when the edit ends. 
+    # If it could not be started, the new dependency is rolled back instead of being left uncommitted
+    if getattr(depController, 'editor', None) is None:
+      transaction.abort()
+    elif transaction.nested:
+      transaction.commit()
+    
   def createConstituentAnnotation(self, sender):
     # create a new dependency relation
     transaction = transaction = self.representedObject.__db__.transaction()
@@ -19,6 +19,7 @@
 
 
 from model import Document
+import persistentdb
 import os, sys, json
 
 def make_from_json(jsonData, filename, removeOld = False):
@@ -26,8 +27,8 @@ def make_from_json(jsonData, filename, removeOld = False):
     try: os.remove(filename)
     except(OSError): pass
     
-  # create the document
-  document = Document(filename)  
+  # create the document (its a one-off import, so we don't need to sync every commit)
+  document = Document(filename, policy = persistentdb.BulkPolicy)  
   
   # set up a mock example
   trn = document.database.transaction()
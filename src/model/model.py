@@ -37,13 +37,32 @@ class Document(object):
   variableDefinitionsLookup = dict(((decl.key,decl.value), decl) for decl in variableDefinitions)
   variableKeys              = sorted(tuple(set(decl.key for decl in variableDefinitions)))
   variableValues              = sorted(tuple(set(decl.value for decl in variableDefinitions)))
+  # the attributes in the attribute index of the database (see objectsByCondition)
+  indexedAttributes         = ('transcription', '_gloss', '_variables')
+  # the tokens are stored as compact records, with the variables encoded as codes (seeded with the declared variables)
+  recordLayouts             = {
+    'Token' : persistentdb.RecordLayout(('transcription', '_span', '_gloss', '_variables', 'refmark'), ('_variables', ), 
+                                        sorted(set((decl.key, decl.value) for decl in variableDefinitions)))
+  }
   
-  def __init__(self, file):
-    # load the database
+  def __init__(self, file, engine = persistentdb.SQLStorageEngine, **options):
+    # load the database (the options, such as the storage policy, go to the storage engine)
+    # the documents are stored with the SQL engine, persistentdb.MemoryStorageEngine keeps them in memory
+    options.setdefault('indexed_attributes', Document.indexedAttributes)
+    options.setdefault('layouts', Document.recordLayouts)
     self.database = persistentdb.DB(file,
-                                     persistentdb.SQLStorageEngine, 
-                                     schema = Document.persistenceSchema)
+                                     engine, 
+                                     schema = Document.persistenceSchema,
+                                     **options)
+    
+    # the task that writes the coalesced commits (see StoragePolicy.commit_window), the application 
+    # sets it up and the document stops it when it is closed
+    self.flushTask = None
                                      
+    # a read-only document can't be initialised or migrated, it must be up to date
+    if self.database.readonly and self.database.root['__version__'] != Document.schemaVersion:
+      raise ValueError('Database must be opened for writing first to initialise or update it')
+    
     # make sure that the key variables are initialised
     if self.database.root['__version__'] is None: 
       transaction = self.database.transaction()
@@ -60,16 +79,28 @@ class Document(object):
     # link back the document
     self.database.document = self
     
-    # run migrations
-    self.__migration()
+    # run migrations (a read-only document is already up to date)
+    if not self.database.readonly:
+      self.__migration()
     
     
     # refmark index support
     self._refmarkList = {}
     
   def close(self):
+    # stop writing the coalesced commits periodically, and write the last ones
+    if self.flushTask is not None:
+      self.flushTask.stop()
+      self.flushTask = None
+    self.database.flush()
+    
     self.database.close()
     self.database = None
+    
+  def refresh(self):
+    """ Moves a read-only document to the latest saved state. The objects retrieved before should not be used anymore """
+    self.database.refresh()
+    self._refmarkList = {}
                                    
   # ---- document properties
   @observable_property
@@ -97,25 +128,29 @@ class Document(object):
     self.database.root['spans'] = self.database.root['spans'] + [span]    
     return span      
   
+  # ---- bulk loading
+  def prefetch(self):
+    """ Loads all the annotation objects in bulk. The data is only kept while the returned objects are alive """
+    return self.database.prefetch(classes = (Span, Token, Constituent, DependencyRelation, ReferenceMark))
+    
   # ---- migrations
   def __migration(self):
+    # the objects to migrate are looked up in the attribute index, the constituents are streamed in batches
     transaction = self.database.transaction()
     with transaction:
       # add refmarks
-      for constituent in self.constituents:
+      for constituent in self.database.iterObjectsByClass(Constituent):
         if not hasattr(constituent, 'refmark'):
           constituent.refmark = None
           
       # replace perfect by past for participles
-      for span in self.spans:
-        for token in span.tokens:
-          if (token.variables.get_value_without_checks('PoS') == 'Verb') and (token.variables.get_value_without_checks('Mode') == 'participle') and (token.variables.get_value_without_checks('Tense/Aspect') == 'perfect'):
-            logging.info((u"Migrating %s tense/aspect" % token).encode("utf-8"))
-            token.variables['Tense/Aspect'] = 'past'
+      for token in self.database.objectsByCondition({'_variables.PoS' : 'Verb', '_variables.Mode' : 'participle', '_variables.Tense/Aspect' : 'perfect'}, Token):
+        logging.info((u"Migrating %s tense/aspect" % token).encode("utf-8"))
+        token.variables['Tense/Aspect'] = 'past'
             
-          if (token.variables.get_value_without_checks('PoS') == 'Pronoun') and (token.variables.get_value_without_checks('Type') == 'WH'):
-            logging.info((u"Migrating %s WH pronoun" % token).encode("utf-8"))
-            token.variables['Type'] = 'interrogative'
+      for token in self.database.objectsByCondition({'_variables.PoS' : 'Pronoun', '_variables.Type' : 'WH'}, Token):
+        logging.info((u"Migrating %s WH pronoun" % token).encode("utf-8"))
+        token.variables['Type'] = 'interrogative'
             
           
             
@@ -128,17 +163,14 @@ class Document(object):
       #     constituent.variables['PhraseType'] = u"Complement clause"
 
       # change PhraseType:Complement clause to PhraseType:Clause
-      for constituent in self.constituents:
-        if constituent.variables.get_value_without_checks('PhraseType') == "Complement clause":
-          logging.info((u"Migrating PhraseType:Complement clause to  PhraseType:Clause for %s" % constituent).encode("utf-8"))
-          constituent.variables['PhraseType'] = u"Clause"
+      for constituent in self.database.objectsByCondition({'_variables.PhraseType' : "Complement clause"}, Constituent):
+        logging.info((u"Migrating PhraseType:Complement clause to  PhraseType:Clause for %s" % constituent).encode("utf-8"))
+        constituent.variables['PhraseType'] = u"Clause"
           
       # replace Default=No by Default=no 
-      for span in self.spans:
-        for token in span.tokens:
-          if (token.variables.get_value_without_checks('Default') == 'No'):
-            logging.info((u"Migrating %s Default No to no" % token).encode("utf-8"))
-            token.variables['Default'] = 'no'
+      for token in self.database.objectsByCondition({'_variables.Default' : 'No'}, Token):
+        logging.info((u"Migrating %s Default No to no" % token).encode("utf-8"))
+        token.variables['Default'] = 'no'
           
               
     transaction.commit()
@@ -234,6 +266,9 @@ class Document(object):
     
   # ---- XML generation
   def constructXMLTree(self):
+    # we are going to touch everything, so load it in one go
+    prefetched = self.prefetch()
+    
     # core elements
     root = ET.Element("AnnoToolDocument", version="1.0", variety = self.variety, type = self.documentType)
     tokens_xml = ET.SubElement(root, "Tokens")
@@ -457,7 +492,8 @@ class Span(object):
   @translation.setter
   def translation(self, value):
     value = unicode(value)
-    spanInfo = self.spanInfo
+    # change a copy, the transaction keeps the old dictionary to roll back to
+    spanInfo = dict(self.spanInfo)
     spanInfo['translation'] = value
     self._spanInfo = spanInfo
 
@@ -862,8 +898,9 @@ class VariablesAccessor(object):
     if not (value is None or value in self.getValidValuesForKey(key)):
       raise ValueError("Invalid value %s %s" % (key, self.getValidValuesForKey(key)))
       
-    # get the variable dictionary  
-    variables = getattr(self.obj, '_variables', {})
+    # get a copy of the variable dictionary (the one of the object is not changed in place, 
+    # so that a savepoint can restore it)
+    variables = dict(getattr(self.obj, '_variables', {}))
     if variables.get(key, None) == value:
       return
       
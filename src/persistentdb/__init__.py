@@ -15,5 +15,8 @@
 
 
 
-from db import DB, PersistenceSchema, Invalid
-from storage_sql import SQLStorageEngine
\ No newline at end of file
+from db import DB, PersistenceSchema, Invalid, ReaderPool
+from query import Condition, Equals, In, Exists, All, Any, Not, Check
+from storage import StorageEngine
+from storage_memory import MemoryStorageEngine
+from storage_sql import SQLStorageEngine, RecordLayout, StoragePolicy, SafePolicy, InteractivePolicy, GroupCommitPolicy, BulkPolicy, backup_database
\ No newline at end of file
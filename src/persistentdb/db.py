@@ -16,8 +16,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import threading, weakref, observing, collections, itertools
+import threading, weakref, observing, collections, itertools, contextlib
 from observing import ObservingContext
+from query import make_condition
 import logging
 
 class Invalid(object):      
@@ -59,6 +60,12 @@ class Transaction(object):
 
   def new(self, cls, *args, **kwargs):
     """ the low-level API of changing persistent objects """
+    
+  def savepoint(self):
+    """ 
+      a nested transaction: committing it keeps its changes in this transaction, 
+      aborting it rolls back only the changes made since it was created 
+    """
       
   @property
   def modifiedInstances(self): pass
@@ -66,26 +73,33 @@ class Transaction(object):
   @property
   def newInstances(self): pass
   
+  # True for the savepoints
+  nested = False
+  
   # ----- current transaction support
-  __threadlocal = threading.local()
-  __threadlocal.current = None
+  # (the transactions entered in the thread, the current one is the last entered one. 
+  # Transactions can be entered within each other, e.g. a savepoint within its transaction)
+  class __CurrentTransaction(threading.local):
+    def __init__(self):
+      self.entered = []
+    
+  __threadlocal = __CurrentTransaction()
   
   @staticmethod
   def getCurrent():
-    current = Transaction.__threadlocal.current
-    if current is None:
+    entered = Transaction.__threadlocal.entered
+    if len(entered) == 0:
       raise ValueError('No current transaction!')
-    return current
+    return entered[-1]
     
   def __enter__(self):
-    assert Transaction.__threadlocal.current is None
-    
-    Transaction.__threadlocal.current = self
+    Transaction.__threadlocal.entered.append(self)
     
   def __exit__(self, etype, evalue, traceback):
-    assert Transaction.__threadlocal.current is self
+    entered = Transaction.__threadlocal.entered
+    assert entered[-1] is self
     
-    Transaction.__threadlocal.current = None
+    entered.pop()
     
     # if there is an unhandled exception, we must rollback!
     if evalue is not None:
@@ -150,12 +164,22 @@ class PersistenceSchema(object):
       
 
 _empty_observing_list = collections.namedtuple('_', 'before,after')((), ())      
+
+def _observers_for_keys(observer_dict, keys, phase):
+  # the before or after observers of the keys (a set) and the global ones, every observer only once
+  observers = []
+  for key, observer_list in observer_dict.iteritems():
+    if key == '__dict__' or key in keys:
+      for o in getattr(observer_list, phase):
+        if o not in observers:
+          observers.append(o)
+  return observers
   
 class DB(object): 
   """
     The engine-independent database interface
   """   
-  def __init__(self, path, engine, schema = None):
+  def __init__(self, path, engine, schema = None, **options):
     # the non-comitted root cache (used to implement root modification)
     self.__rootcache = {}
         
@@ -169,14 +193,23 @@ class DB(object):
     self.__lazyload_classes = {}
     
     # observer storage
-    # the observers are set up as a weak dictionery of objects
-    # to dictionaries of keys to observer lists
+    # the observers are set up as a dictionary of object ids to dictionaries of keys to observer lists,
+    # the entry of an object is removed by a weak reference callback when the object is gone
     # we store the observers outside the instance to simplify the managed storage
     # as __dict__ is directly mirrored to the db
     self.__obj_observers = obj_observers = {}
+    # object id -> weak reference to the object
+    self.__obj_observer_refs = obj_observer_refs = {}
     
-    def remove_wref(wref):
-      del obj_observers[wref]
+    def make_observer_table(obj):
+      key = id(obj)
+      def remove_observer_table(wref):
+        obj_observers.pop(key, None)
+        obj_observer_refs.pop(key, None)
+        
+      obj_observer_refs[key] = weakref.ref(obj, remove_observer_table)
+      observer_dict = obj_observers[key] = dict()
+      return observer_dict
     
     # if a schema is provided, we copy the class implementations from there
     if schema is not None:
@@ -192,15 +225,20 @@ class DB(object):
           __changingF = getattr(cls, '__changing__', None)
           __changedF = getattr(cls, '__changed__', None)
           
+          # True if the changes of the instances must be notified: the class has change hooks or observers 
+          # were set up for one of its instances (when it is False, the transactions skip the notifications)
+          __observed__ = __changingF is not None or __changedF is not None
+          
           # implement the observing data model
           def __key_is_observable__(_, key):
             return key in _.__dict__ or key in specials
 
           def __get_observers_for_key__(_, key):
-            observer_dict = obj_observers.get(_, None)
+            observer_dict = obj_observers.get(id(_), None)
             if observer_dict is None:
-              wref = observing.WeakKey(_, remove_wref)
-              obj_observers[wref] = observer_dict = dict()
+              observer_dict = make_observer_table(_)
+              # the changes of the objects of the class are notified from now on
+              _.__class__.__observed__ = True
               
             return observer_dict.setdefault(key, observing.BeforeAfterObservers())
             
@@ -212,7 +250,7 @@ class DB(object):
             # execute the changing hook
             if _.__changingF is not None: _.__changingF(context)
             # get the observer table
-            observer_dict = obj_observers.get(_, None)
+            observer_dict = obj_observers.get(id(_), None)
             if observer_dict is None:
               return
             # notify the observers for the key
@@ -222,11 +260,28 @@ class DB(object):
             for o in observer_dict.get('__dict__', _empty_observing_list).before:  
               o(_, context) 
               
+          def __keys_changing__(_, keys, context):
+            # one notification for a change of several keys (e.g. a coalesced rollback)
+            if _.__changingF is not None: _.__changingF(context)
+            observer_dict = obj_observers.get(id(_), None)
+            if observer_dict is None:
+              return
+            for o in _observers_for_keys(observer_dict, keys, 'before'):
+              o(_, context)
+              
+          def __keys_changed__(_, keys, context):
+            if _.__changedF is not None: _.__changedF(context)
+            observer_dict = obj_observers.get(id(_), None)
+            if observer_dict is None:
+              return
+            for o in _observers_for_keys(observer_dict, keys, 'after'):
+              o(_, context)
+              
           def __changed__(_, context):
             # execute the changed hook
             if _.__changedF is not None: _.__changedF(context)
             # get the observer table
-            observer_dict = obj_observers.get(_, None)
+            observer_dict = obj_observers.get(id(_), None)
             if observer_dict is None:
               return
             # notify the observers for the key
@@ -244,9 +299,11 @@ class DB(object):
         
     # currently active transactions
     self.__active_transactions = set()
+    # the write set of the active transactions, (object, attribute) -> the transaction that changes it
+    self.__write_set = {}
 
-    # init the storage
-    self.__storage = self.__buildEngineClass(engine)(path)
+    # init the storage (the options are passed on to the engine)
+    self.__storage = self.__buildEngineClass(engine)(path, **options)
     
     # build the transaction class
     self.__transaction_class = self.__buildTransactionClass()
@@ -265,7 +322,12 @@ class DB(object):
     logging.debug("Object %s with id 0x%x became invalid", obj, id(obj))
     
     # clean up the observer table and retrieve the __valid__ observers
-    observer_dict = self.__obj_observers.pop(obj, {})
+    observer_dict = self.__obj_observers.pop(id(obj), None)
+    if observer_dict is None:
+      # nobody observes the object
+      object.__setattr__(obj, '__class__', Invalid)
+      return
+    self.__obj_observer_refs.pop(id(obj), None)
     observers = observer_dict.get('__valid__', _empty_observing_list)
     
     context = ObservingContext(key = '__valid__', new = False, old = True)
@@ -284,6 +346,8 @@ class DB(object):
     active_transactions = self.__active_transactions
     lazyload_classes = self.__lazyload_classes
     db = self
+    # changes the class of an instance, bypassing the __class__ property of the unloaded instances
+    set_class = object.__dict__['__class__'].__set__
     
     class Engine(base):
       def isClassAccepted(self, cls):
@@ -300,28 +364,35 @@ class DB(object):
         # get the lazy load version
         lazy_load_cls = lazyload_classes.get(cls, None)
         if lazy_load_cls is None:
+          # the instance is loaded when an attribute is not found (which is the case for all the stored attributes as the 
+          # __dict__ is empty) or when its __dict__ is used. The loaded instance becomes an instance of cls, so there 
+          # is no cost once it is loaded. The class itself (isinstance, __class__ and the class attributes) doesn't need the data
           class _Lazy(cls):
-            def __getattribute__(_, attr):
-              # set the __dict__ to the decoded data
-              data = self.getPersistentDataForObject(_)
-              
-              object.__setattr__(_, '__dict__', dict(data))
-              object.__setattr__(_, '__class__', cls)
+            def __getattr__(_, attr):
+              # the special attributes are never stored (and are probed by hasattr, e.g. in observing)
+              if attr[:2] == '__' and attr[-2:] == '__':
+                raise AttributeError(attr)
+              self.loadInstance(_)
+              return getattr(_, attr)
               
-              # inform the object that it has been loaded
-              # loaded = getattr(_, '__loaded__', None)
-              # if loaded is not None:
-              #   loaded()
-              # else:
-              #   print u"loaded %s with %s" % (cls, loaded)
+            @property
+            def __dict__(_):
+              self.loadInstance(_)
+              return _.__dict__
               
-              return getattr(_, attr)
+            __class__ = property(lambda _: cls, lambda _, value: set_class(_, value))
         
             def __repr__(_):
-              return _.__getattribute__('__repr__')()
+              self.loadInstance(_)
+              return repr(_)
               
             def __setattr__(_, attr, value):
-              return _.__getattribute__('__setattr__')(attr, value)
+              self.loadInstance(_)
+              setattr(_, attr, value)
+              
+            def __delattr__(_, attr):
+              self.loadInstance(_)
+              delattr(_, attr)
           
           _Lazy.__name__ = 'Lazy+' + cls.__name__
                 
@@ -333,6 +404,13 @@ class DB(object):
         #return object.__new__(cls)
 
         
+      def loadInstance(self, obj):
+        # set the __dict__ of an unloaded instance to the decoded data, it becomes an instance of its class
+        data = dict(self.getPersistentDataForObject(obj))
+        
+        set_class(obj, type(obj).__bases__[0])
+        object.__setattr__(obj, '__dict__', data)
+        
       def getDataForPersistenceCandidate(_, obj):
         # ok, this is a special function
         # its called when we try to commit an object which is unknown
@@ -352,12 +430,74 @@ class DB(object):
   def __buildTransactionClass(self): 
     # db state needed by the transactions
     active_transactions = self.__active_transactions
+    write_set = self.__write_set
     storage = self.__storage
     db_schema_class_to_db_class = self.__schema_class_to_db_class
     db = self
     rootcache = self.__rootcache
     make_invalid = self.__makeObjectInvalid
     
+    class db_Savepoint(Transaction):
+      """ 
+        A savepoint within a transaction (see db_Transaction.savepoint). The changes are made by the transaction,
+        the savepoint only keeps what is needed to roll them back
+      """
+      __db__ = self
+      nested = True
+      
+      def __init__(self, transaction):
+        self.transaction = transaction
+        # (object, attribute) -> (the value before the savepoint, True if the transaction changed it before)
+        self.undo = {}
+        # object -> True if the transaction changed the object before the savepoint
+        self.touched = {}
+        # root item -> (True if it was in the root cache, the cached value, True if the transaction changed it before)
+        self.root_undo = {}
+        # the objects created after the savepoint
+        self.created = []
+        
+      def merge(self, savepoint):
+        # take over the changes of an inner savepoint, the state before this savepoint is kept
+        for key, value in savepoint.undo.iteritems():
+          self.undo.setdefault(key, value)
+        for obj, value in savepoint.touched.iteritems():
+          self.touched.setdefault(obj, value)
+        for name, value in savepoint.root_undo.iteritems():
+          self.root_undo.setdefault(name, value)
+        self.created.extend(savepoint.created)
+        
+      def commit(self):
+        self.transaction.releaseSavepoint(self)
+        
+      def abort(self):
+        self.transaction.rollbackToSavepoint(self)
+        
+      def savepoint(self):
+        return self.transaction.savepoint()
+        
+      def isModifyingObject(self, obj):
+        return self.transaction.isModifyingObject(obj)
+        
+      @property
+      def changedObjects(self):
+        return self.transaction.changedObjects
+        
+      def set_root_item(self, name, value):
+        self.transaction.set_root_item(name, value)
+        
+      def del_root_item(self, name):
+        self.transaction.del_root_item(name)
+        
+      def setattr(self, obj, attr, value):
+        self.transaction.setattr(obj, attr, value)
+        
+      def delattr(self, obj, attr):
+        self.transaction.delattr(obj, attr)
+        
+      def new(self, cls, *args, **kwargs):
+        return self.transaction.new(cls, *args, **kwargs)
+        
+    
     class db_Transaction(Transaction):
       __db__ = self
       active = True
@@ -371,15 +511,139 @@ class DB(object):
         self.__changed_rootattrs = set()
         self.__initialstate = {}
         self.__rollbackinprogress = False
+        # the open savepoints, the innermost one is the last
+        self.__savepoints = []
         # mark the transaction as active
         active_transactions.add(self) 
         
       def isModifyingObject(self, obj):
         return obj in self.__changes
         
+      def __markChanged(self, obj, attr):
+        # add the attribute to the changes of the transaction (object -> set of attributes)
+        changed_attributes_for_object = self.__changes.get(obj, None)
+        
+        if changed_attributes_for_object is None or attr not in changed_attributes_for_object:
+          # it can't be modified by another transaction at the same time
+          if write_set.setdefault((obj, attr), self) is not self:
+            raise ValueError('The attribute %s has been modified in another transaction!' % attr)
+          if changed_attributes_for_object is None:
+            changed_attributes_for_object = self.__changes[obj] = set()
+          changed_attributes_for_object.add(attr)
+          
+      def __releaseWriteSet(self):
+        # the attributes can be changed by other transactions again
+        for obj, attributes in self.__changes.iteritems():
+          for attr in attributes:
+            write_set.pop((obj, attr), None)
+        
       @property
       def changedObjects(self):
         return self.__changes.iterkeys()
+        
+      # ----- savepoints
+      def savepoint(self):
+        savepoint = db_Savepoint(self)
+        self.__savepoints.append(savepoint)
+        return savepoint
+        
+      def __saveForRollback(self, obj, attr):
+        # remember the state of the attribute before its first change under the innermost savepoint
+        savepoint = self.__savepoints[-1]
+        if (obj, attr) not in savepoint.undo:
+          changed_attributes_for_object = self.__changes.get(obj, None)
+          changed = changed_attributes_for_object is not None
+          savepoint.touched.setdefault(obj, changed)
+          savepoint.undo[(obj, attr)] = (obj.__dict__.get(attr, NoValue), changed and attr in changed_attributes_for_object)
+          
+      def __closeSavepoints(self, savepoint):
+        # close the savepoint and the ones within it, the changes made after them are merged into the savepoint
+        try:
+          index = self.__savepoints.index(savepoint)
+        except ValueError:
+          raise RuntimeError('The savepoint is not open in this transaction')
+        
+        closed = self.__savepoints[index:]
+        del self.__savepoints[index:]
+        for inner in closed[1:]:
+          savepoint.merge(inner)
+          inner.__class__ = Invalid
+        
+      def releaseSavepoint(self, savepoint):
+        # the changes stay in the transaction, the enclosing savepoint (if any) must still be able to roll them back
+        self.__closeSavepoints(savepoint)
+        if len(self.__savepoints) > 0:
+          self.__savepoints[-1].merge(savepoint)
+        savepoint.__class__ = Invalid
+        
+      def rollbackToSavepoint(self, savepoint):
+        # only the changes made after the savepoint are rolled back (and only their observers are notified)
+        self.__closeSavepoints(savepoint)
+        
+        self.__rollbackinprogress = True
+        self.__enter__()
+        logging.info("Rolling back a savepoint of transaction 0x%x", id(self))
+        
+        try:
+          created = set(savepoint.created)
+          
+          # the attributes of each object, so that the rollback hooks are called once per object
+          attributes_by_object = {}
+          for (obj, attr), (value, changed) in savepoint.undo.iteritems():
+            if obj not in created:
+              attributes_by_object.setdefault(obj, []).append((attr, value, changed))
+              
+          for obj, attributes in attributes_by_object.iteritems():
+            if hasattr(obj, '__beforeRollback__'): obj.__beforeRollback__()
+            changed_attributes_for_object = self.__changes.get(obj, set())
+            observed = obj.__observed__
+            for attr, value, changed in attributes:
+              old = obj.__dict__.get(attr, NoValue)
+              if old is not value:
+                if observed:
+                  context = ObservingContext(key = attr, new = value, old = old)
+                  obj.__changing__(context)
+                if value is NoValue:
+                  del obj.__dict__[attr]
+                else:
+                  obj.__dict__[attr] = value
+                if observed:
+                  obj.__changed__(context)
+                
+              # the attributes that were first changed after the savepoint are not part of the transaction anymore
+              if not changed:
+                changed_attributes_for_object.discard(attr)
+                if write_set.get((obj, attr), None) is self:
+                  del write_set[(obj, attr)]
+                  
+            if not savepoint.touched[obj] and len(changed_attributes_for_object) == 0:
+              self.__changes.pop(obj, None)
+            if hasattr(obj, '__afterRollback__'): obj.__afterRollback__()
+            
+          # the objects created after the savepoint are gone
+          for obj in savepoint.created:
+            for attr in self.__changes.pop(obj, ()):
+              if write_set.get((obj, attr), None) is self:
+                del write_set[(obj, attr)]
+            make_invalid(obj)
+            
+          for name, (cached, value, changed) in savepoint.root_undo.iteritems():
+            if cached:
+              rootcache[name] = value
+            else:
+              rootcache.pop(name, None)
+            if not changed:
+              self.__changed_rootattrs.discard(name)
+        finally:
+          self.__exit__(None, None, None)
+          self.__rollbackinprogress = False
+          savepoint.__class__ = Invalid
+          
+      def __invalidateSavepoints(self):
+        # the savepoints end with the transaction
+        for savepoint in self.__savepoints:
+          savepoint.__class__ = Invalid
+        del self.__savepoints[:]
       
       def commit(self): 
         logging.info("Committing transaction 0x%x", id(self))
@@ -388,9 +652,12 @@ class DB(object):
           root_item_changes = {name:rootcache[name] for name in self.__changed_rootattrs}
           
           # compute the to be commited states for the objects
+          # the new objects are committed as they are, only the stored ones need their stored data
+          changed_objects = self.__changes.keys()
           objects = {}
-          for obj, attributes in self.__changes.iteritems():
-            d = storage.getPersistentDataForObject(obj) 
+          for obj, stored in itertools.izip(changed_objects, storage.objectsPersistencyStatus(changed_objects)):
+            attributes = self.__changes[obj]
+            d = storage.getPersistentDataForObject(obj) if stored else None
             if d is None:
               d = obj.__dict__
             else:
@@ -407,14 +674,16 @@ class DB(object):
             objects[obj] = d
             logging.debug("Commit %s with data %s", obj, d)
                                         
-          # commit the changes
-          storage.commitChanges(objects, root_item_changes)
+          # commit the changes (the storage only needs to recount references in the changed attributes)
+          storage.commitChanges(objects, root_item_changes, self.__changes)
           
-          # invalidate the objects that went out of scope
-          # python docs seem to suggest that keys will be iterated in the same order
-          # if no changes happen to the dictionary, but let's be on the safe side here
-          objects_to_check  = tuple(objects.iterkeys())
-          invalid_objects = [obj for obj, refcount in itertools.izip(objects_to_check, storage.getRefcountsForObjects(objects_to_check)) if refcount == 0]
+          # invalidate the objects that went out of scope: the ones that were not stored 
+          # and the stored ones that were released (their refcounts are read in one go)
+          stored_objects = []
+          invalid_objects = []
+          for obj, stored in itertools.izip(changed_objects, storage.objectsPersistencyStatus(changed_objects)):
+            (stored_objects if stored else invalid_objects).append(obj)
+          invalid_objects.extend(obj for obj, refcount in itertools.izip(stored_objects, storage.getRefcountsForObjects(stored_objects)) if refcount == 0)
           
           for obj in invalid_objects:
             make_invalid(obj)  
@@ -429,6 +698,8 @@ class DB(object):
             
           # and make sure the transaction is not active anymore
           active_transactions.discard(self)           
+          self.__releaseWriteSet()
+          self.__invalidateSavepoints()
           del self.__changes
           del self.__changed_rootattrs
           del self.__initialstate
@@ -441,38 +712,60 @@ class DB(object):
         logging.info("Finished committing transaction 0x%x", id(self))
         
 
-      def abort(self):         
+      # rollbacks of more objects are coalesced (see abort)
+      coalesced_rollback_threshold = 100
+      
+      def abort(self, coalesce = None):         
+        """
+          roll back the changes. A coalesced rollback restores all the objects first and then notifies 
+          each of them once, instead of notifying every attribute as it is restored. By default, the rollbacks 
+          of more than coalesced_rollback_threshold objects are coalesced
+        """
+        if coalesce is None:
+          coalesce = len(self.__changes) > self.coalesced_rollback_threshold
+          
         self.__rollbackinprogress = True
         
         self.__enter__()
         
         logging.info("Rolling back transaction %x", id(self))
         
-        
-        for obj, attributes in self.__changes.iteritems():
-          d = storage.getPersistentDataForObject(obj) 
+        if coalesce:
+          self.__rollbackCoalesced()
+        else:
+          for obj, attributes in self.__changes.iteritems():
+            d = storage.getPersistentDataForObject(obj) 
 
-          #if d is None: d = {}
-          logging.debug("Rolling back %s with data %s to original data 0x%s", obj, obj.__dict__, d)
+            #if d is None: d = {}
+            logging.debug("Rolling back %s with data %s to original data 0x%s", obj, obj.__dict__, d)
           
-          if d is not None:
-            # restore all changed attributes from the persistent data
-            if hasattr(obj, '__beforeRollback__'): obj.__beforeRollback__()
-            for attr in attributes:
-              if attr in d:
-                value = d[attr]
-                context = ObservingContext(key = attr, new = value, old = obj.__dict__.get(attr, NoValue))
-                obj.__changing__(context)
-                obj.__dict__[attr] = d[attr]
-                obj.__changed__(context)
+            if d is not None:
+              # restore all changed attributes from the persistent data
+              if hasattr(obj, '__beforeRollback__'): obj.__beforeRollback__()
+              if obj.__observed__:
+                for attr in attributes:
+                  if attr in d:
+                    value = d[attr]
+                    context = ObservingContext(key = attr, new = value, old = obj.__dict__.get(attr, NoValue))
+                    obj.__changing__(context)
+                    obj.__dict__[attr] = d[attr]
+                    obj.__changed__(context)
+                  else:
+                    context = ObservingContext(key =  attr, new = NoValue, old = obj.__dict__[attr])
+                    obj.__changing__(context)
+                    del obj.__dict__[attr]
+                    obj.__changed__(context)
               else:
-                context = ObservingContext(key =  attr, new = NoValue, old = obj.__dict__[attr])
-                obj.__changing__(context)
-                del obj.__dict__[attr]
-                obj.__changed__(context)
-            if hasattr(obj, '__afterRollback__'): obj.__afterRollback__()
-          else:
-            make_invalid(obj)
+                # nobody observes the class, the attributes are restored without notifications
+                __dict__ = obj.__dict__
+                for attr in attributes:
+                  if attr in d:
+                    __dict__[attr] = d[attr]
+                  else:
+                    __dict__.pop(attr, None)
+              if hasattr(obj, '__afterRollback__'): obj.__afterRollback__()
+            else:
+              make_invalid(obj)
               
         
         self.__exit__(None, None, None)
@@ -483,6 +776,8 @@ class DB(object):
            
         # and make sure the transaction is not active anymore  
         active_transactions.discard(self) 
+        self.__releaseWriteSet()
+        self.__invalidateSavepoints()
         del self.__changes
         del self.__changed_rootattrs
         
@@ -495,11 +790,46 @@ class DB(object):
         
         
         
+      def __rollbackCoalesced(self):
+        # the stored data of the objects, the new objects have none
+        restored = []
+        invalid_objects = []
+        for obj, attributes in self.__changes.iteritems():
+          d = storage.getPersistentDataForObject(obj)
+          if d is None:
+            invalid_objects.append(obj)
+          else:
+            restored.append((obj, attributes, d, ObservingContext(action = 'rollback', keys = tuple(attributes))))
+            
+        # 1. tell the objects (and their observers) that they are about to be rolled back
+        for obj, attributes, d, context in restored:
+          if hasattr(obj, '__beforeRollback__'): obj.__beforeRollback__()
+          if obj.__observed__: obj.__keys_changing__(attributes, context)
+          
+        # 2. restore all of them, the new objects become invalid
+        for obj, attributes, d, context in restored:
+          __dict__ = obj.__dict__
+          for attr in attributes:
+            if attr in d:
+              __dict__[attr] = d[attr]
+            else:
+              __dict__.pop(attr, None)
+              
+        for obj in invalid_objects:
+          make_invalid(obj)
+          
+        # 3. and notify them once everything is consistent again
+        for obj, attributes, d, context in restored:
+          if obj.__observed__: obj.__keys_changed__(attributes, context)
+          if hasattr(obj, '__afterRollback__'): obj.__afterRollback__()
+        
       def set_root_item(self, name, value):
         if self.__rollbackinprogress: return
         
         # check if we can shedule the root value modification or if another transation already does it
         if name in self.__changed_rootattrs or name not in rootcache:
+          if self.__savepoints:
+            self.__savepoints[-1].root_undo.setdefault(name, (name in rootcache, rootcache.get(name, None), name in self.__changed_rootattrs))
           rootcache[name] = value
           self.__changed_rootattrs.add(name)
           
@@ -508,6 +838,8 @@ class DB(object):
         
         # check if we can shedule the root value modification or if another transation already does it
         if name in self.__changed_rootattrs or name not in rootcache:
+          if self.__savepoints:
+            self.__savepoints[-1].root_undo.setdefault(name, (name in rootcache, rootcache.get(name, None), name in self.__changed_rootattrs))
           rootcache[name] = None
           self.__changed_rootattrs.add(name)
             
@@ -527,22 +859,16 @@ class DB(object):
         #print 'attempting to change', attr, 'of', object.__repr__(obj)
         
         
-        # 1. get the list of changed attributes for the given object
-        changed_attributes_for_object = self.__changes.get(obj, [])
-        
-        # 2. if this transaction did not already change, we must do some additioal testing 
-        if attr not in changed_attributes_for_object:
-          # was it modified by another transaction? this would be an error
-          if len(active_transactions)>1:
-            for txn in active_transactions:
-              if txn is not self:
-                if attr in txn.__changes.get(obj, []):
-                  raise ValueError('The attribute %s has been modified in another transaction!' % attr)
-          # mark it as modified
-          changed_attributes_for_object.append(attr)
-          self.__changes[obj] = changed_attributes_for_object
+        # 1. mark the attribute as changed by this transaction (and keep its value for the savepoint rollback)
+        if self.__savepoints:
+          self.__saveForRollback(obj, attr)
+        self.__markChanged(obj, attr)
+          
+        # 2. change the attribute and notify the observers (if anyone observes the class). Yes, its that simple
+        if not obj.__observed__:
+          obj.__dict__[attr] = value
+          return
           
-        # 3. change the attribute and notify the observers. Yes, its that simple
         context = ObservingContext(key = attr, new = value, old = obj.__dict__.get(attr, NoValue))
 
          # print "Changing %s with context %s" % (obj, context)
@@ -559,22 +885,16 @@ class DB(object):
         # TODO: make sure that we cannot reference objects which are not in store because it means that they are defined
         #   by another transaction!
         
-        # 1. get the list of changed attributes for the given object
-        changed_attributes_for_object = self.__changes.get(obj, [])
-        
-        # 2. if this transaction did not already change, we must do some additioal testing 
-        if attr not in changed_attributes_for_object:
-          # was it modified by another transaction? this would be an error
-          if len(active_transactions)>1:
-            for txn in active_transactions:
-              if txn is not self:
-                if attr in txn.__changes.get(obj, []):
-                  raise ValueError('The attribute %s has been modified in another transaction!' % attr)
-          # mark it as modified
-          changed_attributes_for_object.append(attr)
-          self.__changes[obj] = changed_attributes_for_object
+        # 1. mark the attribute as changed by this transaction (and keep its value for the savepoint rollback)
+        if self.__savepoints:
+          self.__saveForRollback(obj, attr)
+        self.__markChanged(obj, attr)
+          
+        # 2. delet the attribute. Yes, its that simple
+        if not obj.__observed__:
+          del obj.__dict__[attr]
+          return
           
-        # 3. delet the attribute. Yes, its that simple
         context = ObservingContext(key = attr, new = NoValue, old = obj.__dict__[attr])
 
         obj.__changing__(context)  
@@ -593,7 +913,9 @@ class DB(object):
         #obj.__init__(*args, **kwargs)
         
         # and add it to the transaction change log
-        self.__changes[obj] = []
+        self.__changes[obj] = set()
+        if self.__savepoints:
+          self.__savepoints[-1].created.append(obj)
         
         return obj
         
@@ -647,10 +969,93 @@ class DB(object):
         
     return objects
     
+  def iterObjectsByClass(self, cls, batch_size = 1000):
+    """ 
+      iterate the objects of the class without loading all of them at once.
+      The stored objects are loaded batch_size at a time
+    """
+    cls = self.__schema_class_to_db_class.get(cls, cls)
+    
+    # the objects of the active transactions go first
+    pending = set()
+    for txn in list(self.__active_transactions):
+      for obj in list(txn.changedObjects):
+        if isinstance(obj, cls) and obj not in pending:
+          pending.add(obj)
+          yield obj
+    
+    # then the stored ones 
+    for obj in self.__storage.iterObjectsByClass(cls, batch_size):
+      if obj not in pending:
+        yield obj
+    
+  def materialize(self, objects):
+    """ 
+      load the given objects that are not loaded yet at once (e.g. the tokens of a span), 
+      instead of one at a time on their first access
+    """
+    lazy_classes = set(self.__lazyload_classes.itervalues())
+    unloaded = [obj for obj in objects if type(obj) in lazy_classes]
+    if len(unloaded) == 0:
+      return
+      
+    # the data of the objects is read in bulk (and cached for as long as prefetched is alive)
+    prefetched = self.__storage.prefetch((), unloaded)
+    for obj in unloaded:
+      # an object can occur more than once
+      if type(obj) in lazy_classes:
+        self.__storage.loadInstance(obj)
+    
+  def prefetch(self, classes = (), objects = ()):
+    """ 
+      load the data of all objects of the given classes and of the given objects in bulk.
+      The prefetched data is only kept while the returned objects are alive
+    """
+    classes = [self.__schema_class_to_db_class.get(cls, cls) for cls in classes]
+    
+    return self.__storage.prefetch(classes, objects)
+    
   def objectsByCondition(self, filter, *classes):
-    pass
+    """ 
+      the objects of the classes that satisfy the condition (see query.py), or a key -> value dict.
+      The keys are attribute names or attribute.key for the dictionary attributes (e.g. _variables.PoS)
+    """
+    return set(self.iterObjectsByCondition(filter, *classes))
     
+  def iterObjectsByCondition(self, filter, *classes):
+    """ 
+      iterate the objects of the classes that satisfy the condition. The storage looks up the 
+      keys it has in its attribute index, the other objects are checked one at a time
+    """
+    condition = make_condition(filter)
+    storage = self.__storage
+    
+    # the changed objects are checked directly, as the storage only knows their committed state
+    changed = set()
+    for txn in self.__active_transactions:
+      changed.update(txn.changedObjects)
+      
+    lookups, exact = condition.pushdown(storage.isKeyIndexed)
     
+    for cls in classes:
+      cls = self.__schema_class_to_db_class.get(cls, cls)
+      
+      # query the active transactions
+      for obj in changed:
+        if isinstance(obj, cls) and condition.matches(obj):
+          yield obj
+          
+      # query the database, using the index if possible
+      stored = storage.objectsByIndex(cls, lookups) if len(lookups) > 0 else None
+      if stored is None:
+        stored, checked = storage.iterObjectsByClass(cls), False
+      else:
+        checked = exact
+        
+      for obj in stored:
+        if obj not in changed and (checked or condition.matches(obj)):
+          yield obj
+        
   def getRefcountsForObjects(self, objects):
     if len(objects) == 0:
       return {}
@@ -660,11 +1065,25 @@ class DB(object):
   def objectPersistencyStatus(self, obj):
     """ return True if the current object is stored within the db """
     return self.__storage.objectPersistencyStatus(obj)
+    
+  def objectsPersistencyStatus(self, objects):
+    """ objectPersistencyStatus for a list of objects (a dict object -> status) """
+    return dict(zip(objects, self.__storage.objectsPersistencyStatus(objects)))
               
         
   # ------- transaction management
   def transaction(self):
-    """ create a new transaction """
+    """ create a new transaction (it is an error if a transaction is already active, see savepoint) """
+    return self.__transaction_class()
+    
+  def savepoint(self):
+    """ 
+      create a savepoint within the active transaction, or a new transaction if none is active:
+      committing the savepoint keeps its changes in the active transaction, aborting it rolls back only them
+    """
+    active = self.activeTransaction
+    if active is not None:
+      return active.savepoint()
     return self.__transaction_class()
     
   
@@ -702,10 +1121,109 @@ class DB(object):
       
       return accessor
       
+  # ------- maintenance
+  def collectGarbage(self):
+    """ delete the objects that are not referenced anymore (if the storage defers the collection) """
+    self.__storage.collectGarbage()
+    
+  def checkpoint(self):
+    """ write all committed changes back to the main database file """
+    self.__storage.checkpoint()
+    
+  def flush(self):
+    """ write the commits that the storage policy coalesces (see StoragePolicy.commit_window) """
+    self.__storage.flush()
+    
+  def vacuum(self):
+    """ compact the database file """
+    self.__storage.vacuum()
+    
+  def snapshot(self, path, batch_size = 1000):
+    """ write a consistent copy of the database to path, while it stays open """
+    self.__storage.backup(path, batch_size)
+    
+  def iterSnapshot(self, path, batch_size = 1000):
+    """ 
+      write a copy of the database to path in small steps, yielding the fraction copied after each one.
+      The copy starts over if there are commits between the steps, it is done when the iteration is finished
+    """
+    return self.__storage.iterBackup(path, batch_size)
+      
+  # ------- read-only access
+  @property
+  def readonly(self):
+    """ True if the database was opened for reading only """
+    return self.__storage.readonly
+    
+  def refresh(self):
+    """ move a read-only database to the latest committed state (the objects retrieved before become stale) """
+    self.__storage.refresh()
+      
   def debug(self):
     self.__storage.debug()
 
     
+class ReaderPool(object):
+  """
+    A pool of read-only databases, so that several threads can read at the same time
+    
+    open_reader is called to open a new reader (a DB opened with readonly = True), 
+    at most size readers are open at the same time. A reader is only used by one 
+    thread at a time, and it is refreshed when it is taken from the pool, so that it
+    sees the latest committed state of the database
+  """
+  def __init__(self, open_reader, size = 4):
+    self.__open_reader = open_reader
+    self.__available = threading.Semaphore(size)
+    self.__lock = threading.Lock()
+    # readers not used at the moment
+    self.__idle = []
+    # all readers opened by the pool
+    self.__readers = []
+    
+  def acquire(self):
+    """ take a reader from the pool (blocks if all the readers are in use) """
+    self.__available.acquire()
+    try:
+      with self.__lock:
+        reader = self.__idle.pop() if self.__idle else None
+      
+      if reader is None:
+        reader = self.__open_reader()
+        with self.__lock:
+          self.__readers.append(reader)
+      else:
+        reader.refresh()
+    except:
+      self.__available.release()
+      raise
+      
+    return reader
+    
+  def release(self, reader):
+    """ return a reader to the pool """
+    with self.__lock:
+      self.__idle.append(reader)
+    self.__available.release()
+    
+  @contextlib.contextmanager
+  def reader(self):
+    """ with pool.reader() as db: ... """
+    reader = self.acquire()
+    try:
+      yield reader
+    finally:
+      self.release(reader)
+      
+  def close(self):
+    """ close all readers (they should not be in use anymore) """
+    with self.__lock:
+      readers, self.__readers, self.__idle = self.__readers, [], []
+      
+    for reader in readers:
+      reader.close()
+    
+    
 # class PersistentObject(object):
 #   """
 #     Changes to the persistent object are simply communicated to the current transaction
@@ -0,0 +1,185 @@
+# Copyright 2018 Taras Zakharko (taras.zakharko)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+  The conditions for DB.objectsByCondition
+
+  A condition is built from key predicates:
+
+    Equals('_variables.PoS', 'Verb')
+    In('_variables.Mode', ('participle', 'infinitive'))
+    Exists('_gloss')
+
+  and combined with All, Any and Not (or &, | and ~). Check(function) tests the object with a function.
+
+  The keys are attribute names, nested keys of dictionary attributes are separated by a dot
+  (_variables.PoS is the value of the PoS key of the _variables attribute).
+
+  The storage answers the key predicates it has in its attribute index, everything else
+  is checked on the objects themselves
+"""
+
+# the value of a missing key
+class MissingType(object):
+  def __repr__(self):
+    return 'Missing'
+
+Missing = MissingType()
+
+def get_key(obj, key):
+  # the value of the key in the object (Missing if there is no such key)
+  attr, _, path = key.partition('.')
+  value = getattr(obj, attr, Missing)
+
+  # walk the nested keys
+  while path and value is not Missing:
+    key, _, path = path.partition('.')
+    value = value.get(key, Missing) if isinstance(value, dict) else Missing
+
+  return value
+
+# the values that the storage can look up in its index (see also storage_sql.indexable_types)
+_indexable_types = (str, unicode, int, long, float, bool)
+
+class Condition(object):
+  """ The condition interface """
+  def matches(self, obj):
+    """ True if the object satisfies the condition """
+    raise NotImplementedError()
+
+  def pushdown(self, is_key_indexed):
+    """
+      The index lookups for the condition: returns a list of (key, values) and a flag.
+      Every object that satisfies the condition has one of the values under each key
+      (values is None if the key just has to exist). If the flag is True the lookups
+      are equivalent to the condition and the objects don't need to be checked
+    """
+    return [], False
+
+  def __and__(self, other):
+    return All(self, other)
+
+  def __or__(self, other):
+    return Any(self, other)
+
+  def __invert__(self):
+    return Not(self)
+
+class Equals(Condition):
+  def __init__(self, key, value):
+    self.key = key
+    self.value = value
+
+  def matches(self, obj):
+    return get_key(obj, self.key) == self.value
+
+  def pushdown(self, is_key_indexed):
+    if is_key_indexed(self.key) and isinstance(self.value, _indexable_types):
+      return [(self.key, (self.value, ))], True
+    return [], False
+
+  def __repr__(self):
+    return 'Equals(%r, %r)' % (self.key, self.value)
+
+class In(Condition):
+  def __init__(self, key, values):
+    self.key = key
+    self.values = frozenset(values)
+
+  def matches(self, obj):
+    return get_key(obj, self.key) in self.values
+
+  def pushdown(self, is_key_indexed):
+    if is_key_indexed(self.key) and all(isinstance(value, _indexable_types) for value in self.values):
+      return [(self.key, tuple(self.values))], True
+    return [], False
+
+  def __repr__(self):
+    return 'In(%r, %r)' % (self.key, tuple(self.values))
+
+class Exists(Condition):
+  def __init__(self, key):
+    self.key = key
+
+  def matches(self, obj):
+    return get_key(obj, self.key) is not Missing
+
+  def pushdown(self, is_key_indexed):
+    if is_key_indexed(self.key):
+      return [(self.key, None)], True
+    return [], False
+
+  def __repr__(self):
+    return 'Exists(%r)' % self.key
+
+class All(Condition):
+  def __init__(self, *conditions):
+    self.conditions = conditions
+
+  def matches(self, obj):
+    return all(condition.matches(obj) for condition in self.conditions)
+
+  def pushdown(self, is_key_indexed):
+    # all the lookups must hold
+    lookups = []
+    exact = True
+    for condition in self.conditions:
+      condition_lookups, condition_exact = condition.pushdown(is_key_indexed)
+      lookups.extend(condition_lookups)
+      exact = exact and condition_exact
+
+    return lookups, exact
+
+  def __repr__(self):
+    return 'All%r' % (self.conditions, )
+
+class Any(Condition):
+  def __init__(self, *conditions):
+    self.conditions = conditions
+
+  def matches(self, obj):
+    return any(condition.matches(obj) for condition in self.conditions)
+
+  def __repr__(self):
+    return 'Any%r' % (self.conditions, )
+
+class Not(Condition):
+  def __init__(self, condition):
+    self.condition = condition
+
+  def matches(self, obj):
+    return not self.condition.matches(obj)
+
+  def __repr__(self):
+    return 'Not(%r)' % (self.condition, )
+
+class Check(Condition):
+  def __init__(self, function):
+    self.function = function
+
+  def matches(self, obj):
+    return bool(self.function(obj))
+
+  def __repr__(self):
+    return 'Check(%r)' % (self.function, )
+
+def make_condition(filter):
+  """ a condition or a key -> value dict (all keys must have the values) """
+  if isinstance(filter, Condition):
+    return filter
+  elif isinstance(filter, dict):
+    return All(*[Equals(key, value) for key, value in filter.iteritems()])
+  else:
+    raise TypeError('%r is not a condition' % (filter, ))
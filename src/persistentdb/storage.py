@@ -0,0 +1,128 @@
+# Copyright 2018 Taras Zakharko (taras.zakharko)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+  The storage engine interface
+
+  DB(path, engine, schema, **options) creates the engine as engine(path, **options). The engine stores
+  the root items (values under a key) and the persistent objects that can be reached from them,
+  the objects are kept as long as they are referenced (by the root items or by other stored objects).
+
+  The values are built from None, bools, numbers, strings, lists, dictionaries and persistent objects
+  (tuples are stored as lists). An object becomes persistent when a committed value refers to it,
+  its data is then taken from the commit or, if it is not part of the commit, from
+  getDataForPersistenceCandidate(obj).
+
+  The database subclasses the engine and provides:
+    makeInstanceForClass(classname)       - an unloaded instance of the class (which loads its data
+                                            with getPersistentDataForObject on the first access)
+    loadInstance(obj)                     - loads an unloaded instance
+    isClassAccepted(cls)                  - True if the objects of the class can be stored
+    getDataForPersistenceCandidate(obj)   - the data of a new object that is not part of the commit
+
+  Every engine must pass the checks in tools/check_storage_engines.py
+"""
+
+class StorageEngine(object):
+  """ The base class of the storage engines, the optional methods have defaults that do nothing """
+
+  # ----- must be implemented by the engines
+  def getRootItem(self, key):
+    """ the value stored under the key (None if there is no such key) """
+    raise NotImplementedError()
+
+  def objectsByClass(self, cls):
+    """ the stored objects of the class, in the order they were stored """
+    raise NotImplementedError()
+
+  def getPersistentDataForObject(self, obj):
+    """ the stored data of the object (a dictionary, which the caller must not change), None if it is not stored """
+    raise NotImplementedError()
+
+  def getRefcountsForObjects(self, objects):
+    """ the number of references to each of the objects (0 for the objects that are not stored) """
+    raise NotImplementedError()
+
+  def commitChanges(self, objects, root_items, changes = None):
+    """
+      store the new data of the objects (object -> data) and the root items (key -> value, None deletes
+      the key) at once: if the commit fails, nothing is changed. The changes (object -> changed attributes)
+      tell which attributes differ from the stored data. Objects that are not stored yet are only stored
+      if a committed value refers to them, the objects that are not referenced anymore are released
+    """
+    raise NotImplementedError()
+
+  # ----- optional
+  def objectPersistencyStatus(self, obj):
+    """ True if the object is stored, False if it is new """
+    return self.getPersistentDataForObject(obj) is not None
+
+  def objectsPersistencyStatus(self, objects):
+    """ objectPersistencyStatus for each of the objects """
+    return [self.objectPersistencyStatus(obj) for obj in objects]
+
+  def iterObjectsByClass(self, cls, batch_size = 1000):
+    """ iterate over the objects of the class, which may load them in batches """
+    return iter(self.objectsByClass(cls))
+
+  def prefetch(self, classes = (), objects = ()):
+    """ load the data of the objects and of the objects of the classes in bulk, returns the loaded objects """
+    return []
+
+  def isKeyIndexed(self, key):
+    """ True if objectsByIndex can answer conditions on the key """
+    return False
+
+  def objectsByIndex(self, cls, conditions):
+    """
+      the objects of the class for which every (key, values) condition holds (the key has one of the values
+      or, if values is None, any value), None if the conditions can't be answered
+    """
+    return None
+
+  @property
+  def readonly(self):
+    """ True if the engine can't commit """
+    return False
+
+  def refresh(self):
+    """ move a read-only engine to the latest state """
+
+  def collectGarbage(self):
+    """ release the unreferenced objects (if the engine defers it) """
+
+  def flush(self):
+    """ make the commits durable (if the engine defers it) """
+
+  def checkpoint(self):
+    """ write the committed changes back to the main storage """
+
+  def vacuum(self):
+    """ compact the storage """
+
+  def backup(self, path, batch_size = 1000):
+    """ write a consistent copy of the storage to path """
+    for fraction in self.iterBackup(path, batch_size):
+      pass
+
+  def iterBackup(self, path, batch_size = 1000):
+    """ write a copy of the storage to path in steps, yielding the fraction copied after each one """
+    raise NotImplementedError('%s can\'t be copied' % self.__class__.__name__)
+
+  def close(self):
+    """ release the resources of the engine """
+
+  def debug(self):
+    """ print the contents of the storage """
@@ -0,0 +1,186 @@
+# Copyright 2018 Taras Zakharko (taras.zakharko)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from storage import StorageEngine
+
+# the values that are stored as they are
+scalar_types = (bool, int, long, float, str, unicode)
+
+def iter_objects(value):
+  # the objects referred to by a stored value
+  if value is None or isinstance(value, scalar_types):
+    return
+  elif type(value) is list:
+    for item in value:
+      for obj in iter_objects(item):
+        yield obj
+  elif type(value) is dict:
+    for key, item in value.iteritems():
+      for obj in iter_objects(key):
+        yield obj
+      for obj in iter_objects(item):
+        yield obj
+  else:
+    yield value
+
+def copy_value(value):
+  # a copy of a stored value, which the caller can change
+  if type(value) is list:
+    return [copy_value(item) for item in value]
+  elif type(value) is dict:
+    return dict((key, copy_value(item)) for key, item in value.iteritems())
+  else:
+    return value
+
+class MemoryStorageEngine(StorageEngine):
+  """
+    A storage engine that keeps everything in memory, for tests, benchmarks and conversions that don't
+    need the database file. The data is lost when the engine is closed
+  """
+  def __init__(self, path = None, **options):
+    # the path and the options of the other engines (the storage policy, the caches, the index...) are ignored
+    self.__path = path
+
+    # key -> value
+    self.__root = {}
+    # object -> stored data, the references are kept as the objects themselves
+    self.__data = {}
+    # object -> number of references
+    self.__refcounts = {}
+    # classname -> {object -> number}, the number gives the order in which the objects were stored
+    self.__classes = {}
+    self.__next_number = 0
+
+  def getRootItem(self, key):
+    return copy_value(self.__root.get(key, None))
+
+  def objectsByClass(self, cls):
+    objects = self.__classes.get(cls.__name__, {})
+    return sorted(objects, key = objects.get)
+
+  def getPersistentDataForObject(self, obj):
+    return self.__data.get(obj, None)
+
+  def getRefcountsForObjects(self, objects):
+    refcounts = self.__refcounts
+    return [refcounts.get(obj, 0) for obj in objects]
+
+  def objectPersistencyStatus(self, obj):
+    return obj in self.__data
+
+  def objectsPersistencyStatus(self, objects):
+    data = self.__data
+    return [obj in data for obj in objects]
+
+  def commitChanges(self, objects, root_items, changes = None):
+    # the commit collects the new state of the touched objects and root items first and only
+    # applies it when everything is encoded, so a failed commit leaves the storage as it was
+    data_table = {}
+    refcount_table = {}
+    root_table = {}
+    new_objects = []
+
+    def get_refcount(obj):
+      refcount = refcount_table.get(obj, None)
+      if refcount is None:
+        refcount = refcount_table[obj] = self.__refcounts.get(obj, 0)
+      return refcount
+
+    def release(value):
+      for obj in iter_objects(value):
+        refcount_table[obj] = get_refcount(obj) - 1
+
+    def encode(value):
+      # the stored copy of the value, which retains the objects it refers to
+      if value is None or isinstance(value, scalar_types):
+        return value
+      elif type(value) in (list, tuple):
+        return [encode(item) for item in value]
+      elif type(value) is dict:
+        return dict((encode(key), encode(item)) for key, item in value.iteritems())
+
+      # a persistent object
+      if not self.isClassAccepted(value.__class__):
+        raise ValueError('Class %s is not persistent and cannot be encoded!' % value.__class__)
+
+      if value not in self.__data and value not in data_table:
+        # a new object: its data is either in the commit or it is a dangling object
+        data = objects.get(value, None)
+        if data is None:
+          data = self.getDataForPersistenceCandidate(value)
+        # register it first, to deal with circular references
+        data_table[value] = None
+        refcount_table[value] = 0
+        new_objects.append(value)
+        data_table[value] = encode(dict(data))
+
+      refcount_table[value] = get_refcount(value) + 1
+      return value
+
+    # the changed objects (the ones that are not stored yet are only stored if they are referenced)
+    for obj, data in objects.iteritems():
+      if obj in self.__data and obj not in data_table:
+        release(self.__data[obj])
+        data_table[obj] = encode(dict(data))
+
+    # the root items
+    for key, value in root_items.iteritems():
+      release(self.__root.get(key, None))
+      root_table[key] = encode(value)
+
+    # release the objects that are not referenced anymore, and everything they refer to
+    collected = set()
+    to_collect = [obj for obj, refcount in refcount_table.iteritems() if refcount <= 0]
+    while len(to_collect) > 0:
+      obj = to_collect.pop()
+      if obj in collected:
+        continue
+      collected.add(obj)
+
+      for ref in iter_objects(data_table[obj] if obj in data_table else self.__data.get(obj, None)):
+        refcount_table[ref] = get_refcount(ref) - 1
+        if refcount_table[ref] <= 0:
+          to_collect.append(ref)
+
+    # everything is encoded, apply the commit
+    for key, value in root_table.iteritems():
+      if value is None:
+        self.__root.pop(key, None)
+      else:
+        self.__root[key] = value
+
+    for obj in new_objects:
+      self.__classes.setdefault(obj.__class__.__name__, {})[obj] = self.__next_number
+      self.__next_number += 1
+
+    self.__data.update(data_table)
+    self.__refcounts.update(refcount_table)
+
+    for obj in collected:
+      self.__data.pop(obj, None)
+      self.__refcounts.pop(obj, None)
+      self.__classes.get(obj.__class__.__name__, {}).pop(obj, None)
+
+  def close(self):
+    self.__root.clear()
+    self.__data.clear()
+    self.__refcounts.clear()
+    self.__classes.clear()
+
+  def debug(self):
+    for key, value in self.__root.iteritems():
+      print 'root', key, value
+    for obj, data in self.__data.iteritems():
+      print object.__repr__(obj), self.__refcounts.get(obj, 0), data
@@ -16,9 +16,10 @@
 
 
 from observing import WeakKey
+from storage import StorageEngine
 from collections import namedtuple
-import sys, os
-import atexit
+import sys, os, itertools, time, collections, functools
+import atexit, logging
 
   
 import msgpack, struct#, sqlite3
@@ -32,17 +33,188 @@ int_packer = struct.Struct('!L')
 # make the map size big enough for 256MB database. We won't use anythign bigger!
 MAP_SIZE = 256*1024*1024
 
-# the object cache record
-ObjCacheEntry = namedtuple('ObjCacheEntry', 'oid,data')
+# the maximal number of bound parameters we use per SQL statement
+# (SQLite can be compiled with a limit as low as 999)
+MAX_SQL_VARIABLES = 900
+
+# the sizes of the 'oid in (...)' lists. The lists are padded to one of these sizes, so that
+# there are only a few distinct statements and they can be reused from the statement cache
+SQL_LIST_SIZES = (1, 4, 16, 64, 256, MAX_SQL_VARIABLES)
+sql_list_placeholders = dict((size, ','.join('?'*size)) for size in SQL_LIST_SIZES)
+
+# the number of prepared statements the connection keeps (must hold all the statements below)
+SQL_STATEMENT_CACHE_SIZE = 200
+
+# the statements used by the engine. SQLite prepares each of them once and then reuses it from 
+# the statement cache of the connection, so they must be fixed strings and not built per call
+sql_select_root_value     = 'select value from root where key = ?'
+sql_delete_root_item      = 'delete from root where key = ?'
+sql_insert_root_item      = 'insert into root values(?, ?)'
+sql_select_object_class   = 'select oid, class from objects where oid = ?'
+sql_select_object_data    = 'select data from objects where oid = ?'
+sql_select_class_objects  = 'select oid, class from objects where class = ?'
+sql_select_class_page     = 'select oid, class, data from objects where class = ? and oid > ?%s order by oid limit ?'
+sql_select_objects_data   = 'select oid, class, data from objects where oid in (%s)'
+sql_select_classes_data   = 'select oid, class, data from objects where class in (%s)'
+sql_select_data_for_oids  = 'select data from objects where oid in (%s)'
+sql_insert_object         = 'insert into objects values(?, ?, ?)'
+sql_update_object_data    = 'update objects set data = ? where oid = ?'
+sql_delete_objects        = 'delete from objects where oid in (%s)'
+sql_insert_class          = 'insert into classes values(?, ?)'
+sql_insert_layout         = 'insert into layouts values(?, ?)'
+sql_insert_interned       = 'insert into interned values(?, ?)'
+sql_select_refcount       = 'select count from refcounts where oid = ?'
+sql_select_refcounts      = 'select oid, count from refcounts where oid in (%s)'
+sql_select_released       = 'select oid from refcounts where count <= 0'
+sql_delete_refcount       = 'delete from refcounts where oid = ?'
+sql_replace_refcount      = 'insert or replace into refcounts values(?, ?)'
+sql_delete_refcounts      = 'delete from refcounts where oid in (%s)'
+sql_select_index_keys     = 'select oid from attr_index where key = ? and class = ?'
+sql_select_index_values   = 'select oid from attr_index where key = ? and class = ? and value in (%s)'
+sql_select_index_matches  = 'select oid, class from objects where oid in (%s)'
+sql_insert_index_entry    = 'insert into attr_index values(?, ?, ?, ?)'
+sql_insert_index_key      = 'insert into index_keys values(?, ?)'
+sql_delete_index_entries  = 'delete from attr_index where oid = ?'
+sql_delete_index_for_oids = 'delete from attr_index where oid in (%s)'
+# the class scans skip the objects left by the deferred collection if they can't collect them
+sql_filter_released       = ' and oid not in (select oid from refcounts where count <= 0)'
+
+def iter_sql_lists(oids):
+  # splits the oids into (placeholders, parameters) chunks for the 'oid in (...)' statements
+  for i in xrange(0, len(oids), MAX_SQL_VARIABLES):
+    chunk = oids[i:(i + MAX_SQL_VARIABLES)]
+    # pad the chunk by repeating the last oid
+    size = next(size for size in SQL_LIST_SIZES if size >= len(chunk))
+    yield sql_list_placeholders[size], chunk + chunk[-1:]*(size - len(chunk))
+
+# the values that can be put into the attribute index
+indexable_types = (str, unicode, int, long, float, bool)
+
+def index_value(value):
+  # the byte strings are stored as text in the index (sqlite refuses non-ascii byte strings)
+  return value.decode('utf-8', 'replace') if isinstance(value, str) else value
+
+def iter_index_entries(data, attributes):
+  # the (key, value) entries of the attribute index for the object data
+  # scalar attributes are indexed under their name, dictionaries under name.key
+  # the keys with values that can't be indexed are entered with a null value, so that we know that they exist
+  for attr in attributes:
+    if attr not in data:
+      continue
+    value = data[attr]
+    if isinstance(value, dict):
+      yield index_value(attr), None
+      for key, item in value.iteritems():
+        yield u'%s.%s' % (index_value(attr), index_value(key)), index_value(item) if isinstance(item, indexable_types) else None
+    else:
+      yield index_value(attr), index_value(value) if isinstance(value, indexable_types) else None
+
+# the compact record layout of a class. The attributes are stored by position, with a bitmask of the 
+# attributes that are present, instead of as a dictionary. The items of the interned attributes (which 
+# must be dictionaries) are stored as the codes of their (key, value) pairs, the seed pairs are interned 
+# in advance. The attributes not listed in the layout are stored in a dictionary after the positional ones
+# A record is the list [class, mask, values..., other attributes] 
+RecordLayout = namedtuple('RecordLayout', 'attributes,interned,seed')
+
+def layout_fields(attributes, interned):
+  # the (bit of the mask, attribute, True if it is interned) fields of a record layout
+  return tuple((1 << bit, attr, attr in interned) for bit, attr in enumerate(attributes))
+
+def decode_reference(get_object, code, data):
+  # the msgpack extension type decoder, bound to the object lookup of an engine with functools.partial
+  # 1 is the code for the object
+  if code == 1: return get_object(int_packer.unpack(data)[0])
+  else: raise ValueError("Unknown extended type: %s" % code)
+
+# the data cache statistics
+CacheStatistics = namedtuple('CacheStatistics', 'hits,misses,size,limit')
+
+class DataCache(object):
+  """
+    A size-bounded LRU cache of the decoded object data (oid -> data). 
+    
+    The cold entries are dropped and are read in again from the database on demand
+  """
+  def __init__(self, limit):
+    self.limit = limit
+    self.hits = 0
+    self.misses = 0
+    self.__items = collections.OrderedDict()
+    
+  def get(self, oid):
+    items = self.__items
+    try:
+      # move the entry to the hot end
+      data = items.pop(oid)
+      items[oid] = data
+    except KeyError:
+      self.misses += 1
+      return None
+    
+    self.hits += 1
+    return data
+    
+  def __contains__(self, oid):
+    return oid in self.__items
+    
+  def __setitem__(self, oid, data):
+    items = self.__items
+    items.pop(oid, None)
+    items[oid] = data
+    
+    # drop the cold entries
+    if self.limit is not None:
+      while len(items) > self.limit:
+        items.popitem(last = False)
+    
+  def discard(self, oid):
+    self.__items.pop(oid, None)
+    
+  def clear(self):
+    self.__items.clear()
+    
+  def __len__(self):
+    return len(self.__items)
+    
+  @property
+  def statistics(self):
+    return CacheStatistics(self.hits, self.misses, len(self.__items), self.limit)
+
+def iter_references(value):
+  # iterates the object references (ExtTypes) in the data decoded without an ext_hook
+  if isinstance(value, ExtType):
+    yield value
+  elif isinstance(value, dict):
+    for item in value.iteritems():
+      for ref in iter_references(item): yield ref
+  elif isinstance(value, (list, tuple)):
+    for item in value:
+      for ref in iter_references(item): yield ref
+
+# the current version of the database layout
+db_version = '1.5'
 
 db_schema = """
 -- the globals table contains important stuff 
 create table globals(
   version text not null, 
-  refcounts blob,
-  classnames blob
+  next_oid integer not null
+);
+insert into globals values('1.5', 1);
+
+-- the class registry, the objects refer to their class by id
+create table classes(
+  id integer primary key,
+  name text not null unique
+);
+
+-- the reference counts of the objects. Only objects not referenced exactly
+-- once are listed here, a missing row means that the refcount is 1. Objects 
+-- with refcount of 0 are garbage waiting for the (deferred) collection
+create table refcounts(
+  oid integer primary key,
+  count integer not null
 );
-insert into globals values('1.0', NULL, NULL);
 
 -- this table contains the root items
 create table root(
@@ -58,53 +230,335 @@ create table objects(
   data blob,
   unique(oid, class)
 );
+
+-- the class scans
+create index objects_class on objects(class);
+
+-- the optional index of the attribute values (only the attributes listed in indexed_attributes
+-- are indexed). Scalar attributes are indexed under their name, dictionaries under name.key
+-- the key names are stored in index_keys
+create table attr_index(
+  oid integer not null,
+  class integer not null,
+  key integer not null,
+  value
+);
+create index attr_index_value on attr_index(key, value, class);
+create index attr_index_oid on attr_index(oid);
+
+create table indexed_attributes(
+  name text primary key
+);
+
+create table index_keys(
+  id integer primary key,
+  name text not null
+);
+
+-- the compact record layouts of the classes (see RecordLayout)
+create table layouts(
+  class integer primary key,
+  layout blob not null
+);
+
+-- the interned (key, value) pairs of the compact records
+create table interned(
+  id integer primary key,
+  item blob not null
+);
 """ 
 
+# schema migrations: old version -> (new version, migration script)
+# the migration functions are run inside a write transaction
+def migrate_1_0(connection):
+  # move the refcount table from the globals blob into its own table
+  connection.execute('create table refcounts(oid integer primary key, count integer not null)')
+  refcounts = connection.execute('select refcounts from globals').fetchone()[0]
+  if refcounts is not None:
+    refcounts = msgpack.unpackb(refcounts)
+    connection.executemany('insert into refcounts values(?, ?)', ((oid, count) for oid, count in refcounts.iteritems() if count > 1))
+  connection.execute('update globals set refcounts = null')
+  
+def migrate_1_1(connection):
+  # add the oid sequence
+  connection.execute('alter table globals add column next_oid integer not null default 1')
+  connection.execute('update globals set next_oid = (select ifnull(max(oid), 0) + 1 from objects)')
+  
+def migrate_1_2(connection):
+  # move the class names from the globals blob into the class registry and index the classes
+  connection.execute('create table classes(id integer primary key, name text not null unique)')
+  classnames = connection.execute('select classnames from globals').fetchone()[0]
+  if classnames is not None:
+    connection.executemany('insert into classes values(?, ?)', enumerate(msgpack.unpackb(classnames)))
+  connection.execute('update globals set classnames = null')
+  connection.execute('create index objects_class on objects(class)')
+  
+def migrate_1_3(connection):
+  # add the (empty) attribute index
+  connection.execute('create table attr_index(oid integer not null, class integer not null, key text not null, value)')
+  connection.execute('create index attr_index_value on attr_index(key, value, class)')
+  connection.execute('create index attr_index_oid on attr_index(oid)')
+  connection.execute('create table indexed_attributes(name text primary key)')
+  
+def migrate_1_4(connection):
+  # add the compact record layouts
+  connection.execute('create table layouts(class integer primary key, layout blob not null)')
+  connection.execute('create table interned(id integer primary key, item blob not null)')
+  # the keys of the attribute index are now codes, the index is rebuilt when the attributes are declared again
+  connection.execute('drop table attr_index')
+  connection.execute('create table attr_index(oid integer not null, class integer not null, key integer not null, value)')
+  connection.execute('create index attr_index_value on attr_index(key, value, class)')
+  connection.execute('create index attr_index_oid on attr_index(oid)')
+  connection.execute('create table index_keys(id integer primary key, name text not null)')
+  connection.execute('delete from indexed_attributes')
+  
+db_migrations = {
+  '1.0' : ('1.1', migrate_1_0),
+  '1.1' : ('1.2', migrate_1_1),
+  '1.2' : ('1.3', migrate_1_2),
+  '1.3' : ('1.4', migrate_1_3),
+  '1.4' : ('1.5', migrate_1_4)
+}
+
+# the locking mode is EXCLUSIVE, or NORMAL if the database is shared with readers
 db_init_connection_script = """
-pragma locking_mode = EXCLUSIVE;
+pragma locking_mode = %s;
 pragma journal_mode = WAL;
-pragma temp_store  = MEMORY;
-PRAGMA synchronous = FULL;
-VACUUM;"""
+pragma temp_store  = MEMORY;"""
+
+# the read-only connections
+db_reader_connection_script = """
+pragma query_only = ON;
+pragma temp_store  = MEMORY;"""
+
+def iter_copy_database(source, path, batch_size, get_version):
+  # writes a copy of the database of the source connection to path in steps of batch_size rows, yielding 
+  # the fraction copied after each step (the copy is done when the iteration is finished)
+  #
+  # SQLite's online backup copies a database in pages, but the sqlite3 module of Python 2 doesn't offer it,
+  # so the rows are copied table by table instead. Like the online backup, the copy starts over if the 
+  # database changed between the steps (get_version returns something else), as the rows copied before 
+  # might have changed. It is written to a temporary file first, so that path always holds a complete database
+  temp_path = path + '.tmp'
+  for suffix in ('', '-journal'):
+    try: os.remove(temp_path + suffix)
+    except OSError: pass
+  
+  target = sqlite3.connect(temp_path)
+  try:
+    # create the tables and the indexes (the internal ones are created by SQLite)
+    tables = []
+    for type, name, sql in source.execute("select type, name, sql from sqlite_master where sql is not null and name not like 'sqlite_%' order by type = 'index'").fetchall():
+      target.execute(sql)
+      if type == 'table':
+        tables.append(name)
+    target.commit()
+    
+    # the statements that copy the rows of each table, in the order of the rowids
+    statements = []
+    for table in tables:
+      columns = ['rowid'] + [column[1] for column in source.execute('pragma table_info(%s)' % table)]
+      statements.append(('select %s from %s where rowid > ? order by rowid limit ?' % (', '.join(columns), table), 
+                         'insert into %s(%s) values(%s)' % (table, ', '.join(columns), ', '.join('?'*len(columns)))))
+    
+    done = False
+    while not done:
+      version = get_version()
+      total = max(sum(source.execute('select count(*) from %s' % table).fetchone()[0] for table in tables), 1)
+      copied = 0
+      done = True
+      
+      for select, insert in statements:
+        last = -(1 << 63)
+        rows = source.execute(select, (last, batch_size)).fetchall()
+        while len(rows) > 0 and done:
+          target.executemany(insert, rows)
+          target.commit()
+          copied += len(rows)
+          yield float(copied)/total
+          
+          # the database changed, start over
+          if get_version() != version:
+            done = False
+          else:
+            last = rows[-1][0]
+            rows = source.execute(select, (last, batch_size)).fetchall()
+        
+        if not done:
+          for table in tables:
+            target.execute('delete from %s' % table)
+          target.commit()
+          break
+  except:
+    target.close()
+    os.remove(temp_path)
+    raise
+  
+  target.close()
+  # an old copy must not be mixed with its write-ahead log 
+  for suffix in ('-wal', '-shm'):
+    try: os.remove(path + suffix)
+    except OSError: pass
+  os.rename(temp_path, path)
+
+def iter_backup_database(path, target_path, batch_size = 1000):
+  # iter_copy_database for a database file, from a read snapshot that is pinned until the copy is done
+  # (the file can be open shared by a writer). The objects are not read, so any version of the database
+  # can be copied
+  connection = sqlite3.connect(path)
+  try:
+    connection.executescript(db_reader_connection_script)
+    connection.execute('begin')
+    try:
+      connection.execute('select version from globals').fetchone()
+    except sqlite3.OperationalError as e:
+      # (a locked database fails here as well)
+      if 'no such table' not in str(e):
+        raise
+      raise ValueError('%s is not a database' % path)
+    for fraction in iter_copy_database(connection, target_path, batch_size, lambda: 0):
+      yield fraction
+  finally:
+    connection.close()
+
+def backup_database(path, target_path, batch_size = 1000):
+  # writes a consistent copy of the database file at path to target_path
+  for fraction in iter_backup_database(path, target_path, batch_size):
+    pass
 
-class SQLStorageEngine(object):   
-  def __init__(self, path): 
+# the durability and maintenance policy of the storage engine
+#   synchronous         - the SQLite synchronous level for commits ('OFF', 'NORMAL' or 'FULL')
+#   checkpoint          - when the WAL is written back to the database file
+#                           'commit'   - after every commit
+#                           'interval' - after a commit, if checkpoint_interval seconds passed since the last checkpoint
+#                           'size'     - whenever the WAL grows beyond checkpoint_pages pages 
+#                           'close'    - only when the database is closed
+#   checkpoint_interval - the time between checkpoints in seconds (for 'interval')
+#   checkpoint_pages    - the WAL size in pages (for 'size')
+#   vacuum              - when the database file is compacted
+#                           'open'     - every time the database is opened
+#                           'freelist' - on open, if the free pages make up more than vacuum_freelist of the file
+#                           'never'    - only on demand, via vacuum()
+#   vacuum_freelist     - the fraction of free pages (for 'freelist')
+#   collect             - when the unreferenced objects are deleted
+#                           'commit'   - as part of the commit that released them
+#                           'deferred' - before the next class scan, when the database is closed or on demand, 
+#                                        via collectGarbage()
+#   commit_window       - the time in seconds during which the commits are coalesced into one SQLite transaction
+#                         (0 writes every commit on its own). The coalesced commits are written when the window 
+#                         is over (by the next commit), on flush() and when the database is closed. A crash loses 
+#                         the commits of the last window at most: they are written atomically, so the database 
+#                         always has the state after one of the commits. The readers only see the written commits
+StoragePolicy = namedtuple('StoragePolicy', 'synchronous,checkpoint,checkpoint_interval,checkpoint_pages,vacuum,vacuum_freelist,collect,commit_window')
+
+# sync, checkpoint, vacuum and collect at every opportunity (the behaviour of the earlier versions)
+SafePolicy = StoragePolicy('FULL', 'commit', 0, 0, 'open', 0, 'commit', 0)
+# every commit is durable, but the maintenance is only done when needed 
+InteractivePolicy = StoragePolicy('FULL', 'size', 0, 1000, 'freelist', 0.25, 'deferred', 0)
+# like InteractivePolicy, but the commits of the last second can be lost (for the rapid edits of the annotator)
+GroupCommitPolicy = StoragePolicy('FULL', 'size', 0, 1000, 'freelist', 0.25, 'deferred', 1.0)
+# for imports and batch conversions, which can be repeated if the machine crashes
+BulkPolicy = StoragePolicy('NORMAL', 'close', 0, 0, 'never', 0, 'commit', 0)
+
+# the commits coalesced into the open SQLite transaction: the time the first one started, 
+# the first oid it gave out and the (id, name) classes, (code, pair) interned pairs and 
+# (code, key) index keys registered by them, which are forgotten if the transaction fails
+CommitGroup = namedtuple('CommitGroup', 'started,first_oid,classes,interned,index_keys')
+
+class SQLStorageEngine(StorageEngine):   
+  def __init__(self, path, policy = InteractivePolicy, cache_size = 100000, shared = False, readonly = False, indexed_attributes = None, lazy_decode = False, layouts = None): 
     # print os.path.join(sys.path[0], path)
     # print path
        
     self.__path = path
+    self.__policy = policy
+    # a read-only engine works on a snapshot of the database, which can be open for writing by
+    # another engine at the same time (if that one is shared)
+    self.__readonly = readonly
+    # the commits that are not written yet (a CommitGroup, see flush())
+    self.__commit_group = None
+    # the number of commits (and refreshes), so that a backup can tell if the database changed
+    self.__commits = 0
     
-    # open the connection
-    self.__connection = sqlite3.connect(path)
-    self.__connection.executescript(db_init_connection_script)
-    self.__cursor = self.__connection.cursor()
-    
-    # check if the database is empty, if yes, execute the schema
-    try:
-      version = self.__connection.execute('select version from globals').fetchone()[0]
-      if version != '1.0': 
+    if readonly:
+      # open the connection and take the snapshot
+      # the connection can be handed over between threads (but not used by two threads at the same time)
+      self.__connection = sqlite3.connect(path, check_same_thread = False, cached_statements = SQL_STATEMENT_CACHE_SIZE)
+      self.__connection.executescript(db_reader_connection_script)
+      self.__cursor = self.__connection.cursor()
+      self.__beginSnapshot()
+      
+      try:
+        version = self.__connection.execute('select version from globals').fetchone()[0]
+      except sqlite3.OperationalError:
+        raise ValueError('%s is not a database' % path)
+      
+      # we can't upgrade the database, so it must be current
+      if version != db_version:
         raise ValueError('Version mismatch!')
-    except sqlite3.OperationalError:
-      self.__connection.executescript(db_schema)
-      self.__connection.execute('PRAGMA wal_checkpoint(RESTART);')
+    else:
+      # open the connection
+      # the transactions are started explicitly, so that the commits can be coalesced (see StoragePolicy)
+      self.__connection = sqlite3.connect(path, cached_statements = SQL_STATEMENT_CACHE_SIZE, isolation_level = None)
+      self.__connection.executescript(db_init_connection_script % ('NORMAL' if shared else 'EXCLUSIVE'))
+      self.__cursor = self.__connection.cursor()
+      
+      # check if the database is empty, if yes, execute the schema
+      try:
+        version = self.__connection.execute('select version from globals').fetchone()[0]
+      except sqlite3.OperationalError:
+        self.__connection.executescript(db_schema)
+        self.__connection.execute('PRAGMA wal_checkpoint(RESTART);')
+        version = db_version
+        
+      # upgrade older databases
+      if version != db_version:
+        self.__migrate(version)
+        
+      # set up the durability and do the maintenance
+      self.__applyPolicy()
+    
     
+    # the decoder of object references
+    self.__decode_reference = functools.partial(decode_reference, self.__getObjectForOID)
     
     # read the class names and the instance id
-    try:
-      self.__classnames = msgpack.unpackb(self.__connection.execute('select classnames from globals').next()[0])
-      for n in self.__classnames:
-        self.makeInstanceForClass(n)
-    except TypeError:
-      self.__classnames = []
-        
+    self.__readGlobals()
+    
+    # the attribute index: None keeps the attributes indexed by the database, 
+    # otherwise the index is rebuilt if the attributes are different
+    if indexed_attributes is not None and not readonly and frozenset(indexed_attributes) != self.__indexed_attributes:
+      self.__rebuildIndex(indexed_attributes)
+      
+    # the record layouts (classname -> RecordLayout) for the classes that don't have one yet 
+    # the layouts of the stored classes can't be changed, as their records depend on them
+    self.__new_layouts = {} if readonly or layouts is None else dict(layouts)
+    for classname in self.__new_layouts.keys():
+      class_i = self.__class_ids.get(classname, None)
+      if class_i is None:
+        continue
+      layout = self.__new_layouts.pop(classname)
+      if class_i not in self.__layouts:
+        self.__convertToLayout(class_i, layout)
+    
+    # the cursor for loading single objects (so that loading never interferes with the other statements)
+    self.__load_cursor = self.__connection.cursor()
+    # the unpacker for the object data, reused for all objects
+    self.__unpacker = self.__makeUnpacker()
+    # keep the data loaded in bulk packed until the object is used
+    self.__lazy_decode = lazy_decode
          
-    # the object cache, consisting of ObjCacheEntry items
+    # the object cache, weakref -> oid
     self.__obj_cache = {}
     # oid -> weakref
     self.__oid_to_wref = {}
+    # the decoded data of the objects, oid -> data (limited to cache_size objects, None means no limit)
+    self.__data_cache = DataCache(cache_size)
       
     # collect list - objects with rc of 0
     self.__to_collect = set()
+    # are there released objects left by the deferred collection?
+    self.__garbage_pending = self.__cursor.execute('select count(*) from refcounts where count <= 0').fetchone()[0] > 0
     
     # ensure the database is closed when the process crashes or exits
     # without propertly calling the close() method
@@ -114,6 +568,284 @@ class SQLStorageEngine(object):
         
     atexit.register(destruct, WeakKey(self))
     
+  def __readGlobals(self):
+    # read the class registry (id -> name and name -> id)
+    self.__classnames = dict(self.__cursor.execute('select id, name from classes'))
+    self.__class_ids = dict((name, class_i) for class_i, name in self.__classnames.iteritems())
+    for n in self.__classnames.itervalues():
+      self.makeInstanceForClass(n)
+      
+    # the oid that will be assigned to the next new object
+    self.__next_oid = self.__cursor.execute('select next_oid from globals').fetchone()[0]
+    
+    # the attributes in the attribute index and the codes of the index keys (name -> code)
+    self.__indexed_attributes = frozenset(name for name, in self.__cursor.execute('select name from indexed_attributes'))
+    self.__index_keys = dict((name, code) for code, name in self.__cursor.execute('select id, name from index_keys'))
+    
+    # the record layouts, class -> (attributes, interned attributes)
+    self.__layouts = dict((class_i, tuple(map(tuple, msgpack.unpackb(layout, encoding = 'utf-8')))) for class_i, layout in self.__cursor.execute('select class, layout from layouts'))
+    # the fields of the records, class -> ((bit, attribute, True if it is interned), ...)
+    self.__layout_fields = dict((class_i, layout_fields(*layout)) for class_i, layout in self.__layouts.iteritems())
+    # the interned pairs (code -> pair and pair -> code), decoded like the object data (although 
+    # __internPair never interns references, which can't be packed without the encoder of the commit)
+    self.__interned = dict((code, tuple(msgpack.unpackb(item, encoding = 'utf-8', ext_hook = self.__decode_reference))) for code, item in self.__cursor.execute('select id, item from interned'))
+    self.__interned_codes = dict((pair, code) for code, pair in self.__interned.iteritems())
+    
+  def __setLayout(self, cursor, class_i, layout, new_interned):
+    # sets up the layout for the class, the new interned pairs are appended to new_interned
+    self.__layouts[class_i] = (tuple(layout.attributes), tuple(layout.interned))
+    self.__layout_fields[class_i] = layout_fields(*self.__layouts[class_i])
+    cursor.execute(sql_insert_layout, (class_i, buffer(msgpack.packb(self.__layouts[class_i]))))
+    
+    for pair in layout.seed:
+      self.__internPair(tuple(pair), new_interned)
+      
+  def __internPair(self, pair, new_interned):
+    # returns the code of the pair, the new pairs are appended to new_interned (and forgotten with it
+    # by __forgetLayouts if the commit fails)
+    code = self.__interned_codes.get(pair, None)
+    if code is None:
+      # pack it first: a pair that can't be packed must not get a code, as it would never be stored
+      packed = buffer(msgpack.packb(pair))
+      code = len(self.__interned)
+      self.__interned[code] = pair
+      self.__interned_codes[pair] = code
+      new_interned.append((code, packed))
+    return code
+    
+  def __forgetLayouts(self, classes, new_interned):
+    # rolls back __setLayout 
+    for class_i in classes:
+      self.__layouts.pop(class_i, None)
+      self.__layout_fields.pop(class_i, None)
+    for code, _ in new_interned:
+      del self.__interned_codes[self.__interned.pop(code)]
+      
+  def __convertToLayout(self, class_i, layout):
+    # sets the layout of a stored class and rewrites its objects
+    connection = self.__connection
+    new_interned = []
+    
+    try:
+      connection.execute('begin')
+      self.__setLayout(connection, class_i, layout, new_interned)
+      
+      # the references stay encoded, as they are in the stored data
+      rows = connection.execute('select oid, data from objects where class = ? and data is not null', (class_i, )).fetchall()
+      connection.executemany(sql_update_object_data, ((buffer(msgpack.packb(self.__compactRecord(class_i, self.__expandRecord(msgpack.unpackb(data, encoding = 'utf-8')), new_interned))), oid) for oid, data in rows))
+      connection.executemany(sql_insert_interned, new_interned)
+      connection.commit()
+    except:
+      connection.rollback()
+      self.__forgetLayouts((class_i, ), new_interned)
+      raise
+      
+  def __compactRecord(self, class_i, data, new_interned):
+    # the stored form of the object data: a record if the class has a layout, the data dictionary otherwise
+    layout = self.__layouts.get(class_i, None)
+    if layout is None:
+      return data
+    attributes, interned = layout
+      
+    record = [class_i, 0]
+    mask = 0
+    
+    for bit, attr in enumerate(attributes):
+      if attr in data:
+        value = data[attr]
+        if attr in interned and isinstance(value, dict):
+          try:
+            value = [self.__internPair((key, item), new_interned) for key, item in value.iteritems()]
+          except TypeError:
+            pass # the items can't be interned (not hashable), the dictionary is stored as it is
+        mask |= 1 << bit
+        record.append(value)
+    record[1] = mask
+    
+    # the other attributes
+    other = dict((attr, value) for attr, value in data.iteritems() if attr not in attributes)
+    if len(other) > 0:
+      record.append(other)
+    
+    return record
+    
+  def __expandRecord(self, data):
+    # the object data for the stored form (see __compactRecord)
+    if type(data) is not list:
+      return data
+    
+    pairs = self.__interned
+    mask = data[1]
+    
+    expanded = {}
+    i = 2
+    for bit, attr, interned in self.__layout_fields[data[0]]:
+      if mask & bit:
+        value = data[i]
+        if interned and type(value) is list:
+          value = dict(map(pairs.__getitem__, value))
+        expanded[attr] = value
+        i += 1
+    
+    if i < len(data):
+      expanded.update(data[i])
+      
+    return expanded
+    
+  def __rebuildIndex(self, attributes):
+    # index the attributes of all the objects
+    attributes = frozenset(attributes)
+    connection = self.__connection
+    
+    try:
+      connection.execute('begin')
+      connection.execute('delete from attr_index')
+      connection.execute('delete from indexed_attributes')
+      connection.execute('delete from index_keys')
+      connection.executemany('insert into indexed_attributes values(?)', ((attr, ) for attr in attributes))
+      
+      # the references are not decoded, they are not indexed anyway
+      self.__index_keys = {}
+      new_index_keys = []
+      rows = connection.execute('select oid, class, data from objects where data is not null')
+      connection.executemany(sql_insert_index_entry, ((oid, class_i, self.__indexKeyCode(key, new_index_keys), value) 
+                                                      for oid, class_i, data in rows 
+                                                      for key, value in iter_index_entries(self.__expandRecord(msgpack.unpackb(data, encoding = 'utf-8')), attributes)))
+      connection.executemany(sql_insert_index_key, new_index_keys)
+      connection.commit()
+    except:
+      connection.rollback()
+      self.__index_keys = dict((name, code) for code, name in connection.execute('select id, name from index_keys'))
+      raise
+      
+    self.__indexed_attributes = attributes
+    
+  def __indexKeyCode(self, key, new_index_keys):
+    # the code of the index key, the new (code, key) are appended to new_index_keys
+    code = self.__index_keys.get(key, None)
+    if code is None:
+      code = self.__index_keys[key] = len(self.__index_keys)
+      new_index_keys.append((code, key))
+    return code
+    
+  @property
+  def indexedAttributes(self):
+    return self.__indexed_attributes
+    
+  def isKeyIndexed(self, key):
+    # keys are either attribute names or attribute.key for the dictionary attributes
+    path = key.split('.', 1)
+    return path[0] in self.__indexed_attributes and (len(path) == 1 or '.' not in path[1])
+    
+  def __beginSnapshot(self):
+    # a read transaction pins the snapshot of the database until it is finished
+    self.__cursor.execute('begin')
+    self.__cursor.execute('select count(*) from sqlite_master').fetchone()
+    
+  def refresh(self):
+    # moves a read-only engine to the latest committed state of the database
+    # the objects retrieved before are detached from the engine and should not be used anymore
+    if not self.__readonly:
+      return
+      
+    self.__connection.commit()
+    self.__beginSnapshot()
+    self.__commits += 1
+    
+    self.__obj_cache.clear()
+    self.__oid_to_wref.clear()
+    self.__data_cache.clear()
+    self.__readGlobals()
+    self.__garbage_pending = self.__cursor.execute('select count(*) from refcounts where count <= 0').fetchone()[0] > 0
+    
+  @property
+  def readonly(self):
+    return self.__readonly
+    
+  def __migrate(self, version):
+    connection = self.__connection
+    
+    try:
+      connection.execute('begin')
+      while version != db_version:
+        if version not in db_migrations:
+          raise ValueError('Version mismatch!')
+        version, migration = db_migrations[version]
+        migration(connection)
+        connection.execute('update globals set version = ?', (version, ))
+      
+      connection.commit()
+    except:
+      connection.rollback()
+      raise
+    
+  def __applyPolicy(self):
+    connection = self.__connection
+    policy = self.__policy
+    
+    connection.execute('pragma synchronous = %s' % policy.synchronous)
+    # with the 'size' policy, SQLite checkpoints the WAL for us
+    connection.execute('pragma wal_autocheckpoint = %d' % (policy.checkpoint_pages if policy.checkpoint == 'size' else 0))
+    
+    self.__last_checkpoint = time.time()
+    
+    # compact the database 
+    if policy.vacuum == 'open':
+      self.vacuum()
+    elif policy.vacuum == 'freelist':
+      page_count = connection.execute('pragma page_count').fetchone()[0]
+      freelist_count = connection.execute('pragma freelist_count').fetchone()[0]
+      if page_count > 0 and float(freelist_count)/page_count > policy.vacuum_freelist:
+        self.vacuum()
+        
+  def checkpoint(self):
+    # write the WAL back to the database and reset it
+    self.flush()
+    self.__connection.execute('pragma wal_checkpoint(truncate);')
+    self.__last_checkpoint = time.time()
+    
+  def vacuum(self):
+    # compact the database file
+    self.flush()
+    self.__connection.execute('VACUUM;')
+    
+  def flush(self):
+    # write the coalesced commits (see StoragePolicy.commit_window)
+    group = self.__commit_group
+    if group is None:
+      return
+      
+    self.__commit_group = None
+    try:
+      self.__connection.commit()
+    except:
+      # the coalesced commits are lost, forget what they gave out
+      self.__connection.rollback()
+      self.__forgetRegistrations(group.classes, group.interned, group.index_keys)
+      self.__next_oid = group.first_oid
+      for oid, wref in self.__oid_to_wref.items():
+        if oid >= group.first_oid:
+          del self.__obj_cache[wref]
+          del self.__oid_to_wref[oid]
+      # the stored data is read in again, and the collected objects are collected again
+      self.__data_cache.clear()
+      self.__garbage_pending = True
+      raise
+    
+    # checkpoint the commits if the policy says so
+    policy = self.__policy
+    if policy.checkpoint == 'commit' or (policy.checkpoint == 'interval' and time.time() - self.__last_checkpoint >= policy.checkpoint_interval):
+      self.checkpoint()
+      
+  def __forgetRegistrations(self, new_classes, new_interned, new_index_keys):
+    # forget the classes, interned pairs and index keys registered by a failed commit
+    for classname_i, classname in new_classes:
+      del self.__classnames[classname_i]
+      del self.__class_ids[classname]
+    self.__forgetLayouts([classname_i for classname_i, _ in new_classes], new_interned)
+    for _, key in new_index_keys:
+      del self.__index_keys[key]
+    
   def __setup_db(self):
     connection = self.__connection
     
@@ -130,8 +862,17 @@ class SQLStorageEngine(object):
     if self.__connection is None: return
     
     
-    # make sure the wal file is reset
-    #self.__connection.execute('pragma wal_checkpoint(RESTART);')
+    # collect the garbage left by the deferred collection
+    if self.__policy.collect == 'deferred' and not self.__readonly:
+      try: self.collectGarbage()
+      except Exception: logging.exception('Garbage collection failed while closing %s', self.__path)
+    
+    # write the coalesced commits and make sure the wal file is reset
+    if not self.__readonly:
+      try: self.flush()
+      except sqlite3.Error: logging.exception('Writing the last commits failed while closing %s', self.__path)
+      try: self.checkpoint()
+      except sqlite3.Error: pass
     # close the connection
     self.__connection.close()
     # remove the wal file
@@ -143,6 +884,16 @@ class SQLStorageEngine(object):
   def __del__(self):
     self.close()  
     
+  def iterBackup(self, path, batch_size = 1000):
+    # writes a copy of the database to path in steps of batch_size rows (see iter_copy_database), the copy 
+    # has the state of the database at the last step. The coalesced commits are written first, as the 
+    # connection sees them before they are
+    def get_version():
+      self.flush()
+      return self.__commits
+      
+    return iter_copy_database(self.__connection, path, batch_size, get_version)
+    
   def debug(self): 
     for line in self.__connection.iterdump():    
       print line
@@ -152,43 +903,105 @@ class SQLStorageEngine(object):
   def __remove_wref(self, wref):
     # remove the wref from the object cache
     try:
-      del self.__oid_to_wref[self.__obj_cache.pop(wref).oid]
+      oid = self.__obj_cache.pop(wref)
+      del self.__oid_to_wref[oid]
+      self.__data_cache.discard(oid)
     except: pass
     
+  @property
+  def cacheStatistics(self):
+    # the hits, misses, size and the limit of the data cache
+    return self.__data_cache.statistics
+    
   def getRootItem(self, key):
     # make sure key msg-encoded encoded!
     key = buffer(msgpack.packb(key))
     
     # get the data from the root table
-    value = self.__cursor.execute('select value from root where key = ?', (key,)).fetchone()
+    value = self.__load_cursor.execute(sql_select_root_value, (key,)).fetchone()
     
     # if there is no such key, we simply return None
     if value is None:
       return None
       
-    # the msgpack extension type decoder
-    # 1 is the code for the object
-    def ext_hook(code, data):
-      if code == 1: return self.__getObjectForOID(int_packer.unpack(data)[0])
-      else: raise ValueError("Unknown extended type: %s" % code)
-    
-    return msgpack.unpackb(value[0], ext_hook=ext_hook)
+    return msgpack.unpackb(value[0], ext_hook = self.__decode_reference)
     
   def objectsByClass(self, cls):
     # get the class id
-    try:
-      class_i = self.__classnames.index(cls.__name__)
-    except ValueError:
+    class_i = self.__class_ids.get(cls.__name__, None)
+    if class_i is None:
       return tuple() # no such data, duh
     
     # stored items. we use this instead of iteration for a number of reasons    
-    oids = list(self.__cursor.execute('select oid from objects where class = ?', (class_i, )))
-    objects = [self.__getObjectForOID(oid[0]) for oid in oids]
+    rows = self.__cursor.execute(sql_select_class_objects + self.__prepareClassScan(), (class_i, )).fetchall()
                         
-    return objects           
+    return self.__getObjectsForRows(rows)
       
     
     
+  def iterObjectsByClass(self, cls, batch_size = 1000):
+    # yields the objects of the class, loading batch_size objects (with their data) at a time
+    # the pages are keyed by the oid, so objects added or removed in between don't disturb the iteration
+    class_i = self.__class_ids.get(cls.__name__, None)
+    if class_i is None:
+      return
+      
+    statement = sql_select_class_page % self.__prepareClassScan()
+    last_oid = 0
+    
+    while True:
+      rows = self.__cursor.execute(statement, (class_i, last_oid, batch_size)).fetchall()
+      if len(rows) == 0:
+        return
+      last_oid = rows[-1][0]
+      
+      for obj in self.__getObjectsForRows(rows):
+        yield obj
+    
+  def objectsByIndex(self, cls, conditions):
+    # the objects of the class which match all the (key, values) conditions, according to the attribute index
+    # the value of the key must be one of the values or, if values is None, the key must have a value 
+    # returns None if the conditions can't be answered by the index
+    if len(conditions) == 0 or not all(self.isKeyIndexed(key) and (values is None or 0 < len(values) <= MAX_SQL_VARIABLES) for key, values in conditions):
+      return None
+      
+    class_i = self.__class_ids.get(cls.__name__, None)
+    codes = [self.__index_keys.get(index_value(key), None) for key, values in conditions]
+    # nothing is stored for an unknown class or key 
+    if class_i is None or None in codes:
+      return []
+    
+    queries = []
+    params = []
+    for code, (key, values) in zip(codes, conditions):
+      if values is None:
+        queries.append(sql_select_index_keys)
+        params.extend((code, class_i))
+      else:
+        placeholders, values = iter_sql_lists(map(index_value, values)).next()
+        queries.append(sql_select_index_values % placeholders)
+        params.extend((code, class_i))
+        params.extend(values)
+
+    # the conditions share one statement, together they must stay in the limit (or we scan instead)
+    if len(params) > MAX_SQL_VARIABLES:
+      return None
+
+    rows = self.__cursor.execute(sql_select_index_matches % ' intersect '.join(queries) + self.__prepareClassScan(), params).fetchall()
+    
+    return self.__getObjectsForRows(rows)
+    
+  def __prepareClassScan(self):
+    # the class scans must not see the released objects: we collect them first or, 
+    # if we can't write, filter them out (returns the filter condition)
+    if not self.__garbage_pending:
+      return ''
+    elif self.__readonly:
+      return sql_filter_released
+    else:
+      self.collectGarbage()
+      return ''
+    
   def __getObjectForOID(self, oid):    
     # if the object is in cache, return that
     wref = self.__oid_to_wref.get(oid, None)
@@ -196,163 +1009,244 @@ class SQLStorageEngine(object):
       return wref()
     
     # we will need to create the instance
-
-    # get the of for the instance
-    classname = self.__classnames[self.__cursor.execute('select class from objects where oid = ?', (oid, )).fetchone()[0]]
+    row = self.__load_cursor.execute(sql_select_object_class, (oid, )).fetchone()
       
-    # otherwise, we need a new instance
-        
-    # make the innstance and add it to the cache to prevent recursion
-    obj = self.makeInstanceForClass(classname)
-    wref = WeakKey(obj, self.__remove_wref)
+    return self.__makeInstance(oid, row[1])
     
-    self.__obj_cache[wref] = ObjCacheEntry(oid, None)
+  def __makeInstance(self, oid, class_i):
+    # make the instance and add it to the cache (before its data is decoded, to prevent recursion)
+    obj = self.makeInstanceForClass(self.__classnames[class_i])
+    wref = WeakKey(obj, self.__remove_wref)
+      
+    self.__obj_cache[wref] = oid
     self.__oid_to_wref[oid] = wref
     
+    return obj
+    
+  def __makeUnpacker(self):
+    return msgpack.Unpacker(encoding = 'utf-8', ext_hook = self.__decode_reference)
+    
+  def __decode(self, packed_data):
+    # decodes the object data with the shared unpacker, which saves setting up the decoder for every object
+    # (the unpacker can't be used recursively, but the references are decoded without loading the objects)
+    unpacker = self.__unpacker
+    unpacker.feed(packed_data)
+    try:
+      return self.__expandRecord(unpacker.unpack())
+    except:
+      # don't leave the rest of broken data in the unpacker
+      self.__unpacker = self.__makeUnpacker()
+      raise
+    
+  def __getObjectsForRows(self, rows):
+    # builds the instances for a list of (oid, class) or (oid, class, data) rows
+    # objects which are already in cache are reused, the others will use lazy loading
+    # unless their data was supplied as part of the row
+    oid_to_wref = self.__oid_to_wref
+    data_cache = self.__data_cache
+    make_instance = self.__makeInstance
+    # the lazy decoding caches the packed data, it is decoded by getPersistentDataForObject
+    decode = self.__decode if not self.__lazy_decode else lambda packed_data: packed_data
+    
+    objects = []
+    
+    # first make all the instances, so that references between the objects 
+    # in the batch are resolved from the cache when decoding the data
+    for row in rows:
+      wref = oid_to_wref.get(row[0], None)
+      objects.append(make_instance(row[0], row[1]) if wref is None else wref())
+      
+    # decode the data if we have it and the object is not yet loaded
+    for row in rows:
+      if len(row) > 2 and row[2] is not None and row[0] not in data_cache:
+        data_cache[row[0]] = decode(row[2])
+    
+    return objects
+    
+  def prefetch(self, classes = (), objects = ()):
+    # load the data of all objects of the given classes and of the given objects in bulk
+    # the prefetched data is only cached while the objects are alive, so the caller
+    # should retain the returned list for as long as it works with the objects
+    cursor = self.__cursor
+    prefetched = []
+    
+    # the classes (only the ones that we have actually stored)
+    class_ids = [self.__class_ids[cls.__name__] for cls in classes if cls.__name__ in self.__class_ids]
+    if len(class_ids) > 0:
+      condition = self.__prepareClassScan()
+      for placeholders, params in iter_sql_lists(class_ids):
+        rows = cursor.execute(sql_select_classes_data % placeholders + condition, params).fetchall()
+        prefetched.extend(self.__getObjectsForRows(rows))
     
-    # we are done here! the object will use lazy loading
-    return obj    
+    # the objects (only the ones that are stored and not yet loaded)
+    oids = []
+    for obj in objects:
+      oid = self.__obj_cache.get(obj, None)
+      if oid is not None and oid not in self.__data_cache:
+        oids.append(oid)
+    
+    for placeholders, params in iter_sql_lists(oids):
+      rows = cursor.execute(sql_select_objects_data % placeholders, params).fetchall()
+      prefetched.extend(self.__getObjectsForRows(rows))
+      
+    return prefetched
     
   def getPersistentDataForObject(self, obj): 
-    cache_entry = self.__obj_cache.get(obj, None)
-    if cache_entry is not None:
-      oid, data = cache_entry
-      if data is None:
-        # the msgpack extension type decoder
-        # 1 is the code for the object
-        def ext_hook(code, data):
-          if code == 1: 
-
-            return self.__getObjectForOID(int_packer.unpack(data)[0])
-          else: raise ValueError("Unknown extended type: %s" % code)
-      
-        packed_data = self.__cursor.execute('select data from objects where oid = ?', (oid,)).fetchone()[0]
+    oid = self.__obj_cache.get(obj, None)
+    if oid is not None:
+      data = self.__data_cache.get(oid)
+      if data is None or type(data) is buffer:
+        # the data is either not loaded or still packed
+        packed_data = self.__load_cursor.execute(sql_select_object_data, (oid,)).fetchone()[0] if data is None else data
                 
-        data = msgpack.unpackb(packed_data, encoding = 'utf-8', ext_hook=ext_hook)  
-
-
-        
-
-        
-        def decode(code, oid):
-          if code == 1: 
-            oid = int_packer.unpack(oid)[0]
-          return oid
+        data = self.__decode(packed_data)
           
-
-          
-        
-          
-        self.__obj_cache[obj] = ObjCacheEntry(oid, data)
+        self.__data_cache[oid] = data
           
       return data
     else:
       return None
   
-  def getRefcountsForObjects(self, objects):
-    # retrieve the refcount table
-    refcount_table = self.__cursor.execute('select refcounts from globals').fetchone()[0]
-    if refcount_table is None:
-      refcount_table = {}
+  def __getRefcount(self, cursor, oid):
+    # objects without an entry in the refcount table are referenced once
+    refcount = cursor.execute(sql_select_refcount, (oid,)).fetchone()
+    if refcount is None:
+      return 1
     else:
-      refcount_table = msgpack.unpackb(refcount_table)
+      return refcount[0]
     
-    # we will store the counts here
-    counts = []
+  def getRefcountsForObjects(self, objects):
+    # the objects which are not stored have no references, the ones without 
+    # an entry in the refcount table are referenced once
+    oids = [self.__obj_cache.get(obj, None) for obj in objects]
     
-    for obj in objects:
-      cache_entry = self.__obj_cache.get(obj, None)
-      if cache_entry is None:
-        counts.append(0)
-      else:
-        counts.append(refcount_table.get(cache_entry.oid, 1))
+    refcounts = {}
+    for placeholders, chunk in iter_sql_lists([oid for oid in oids if oid is not None]):
+      refcounts.update(self.__cursor.execute(sql_select_refcounts % placeholders, chunk))
       
-    return counts  
+    return [0 if oid is None else refcounts.get(oid, 1) for oid in oids]
+    
+  def objectPersistencyStatus(self, obj):
+    # the stored objects are exactly the ones in the object cache (the collected ones are removed from it)
+    return obj in self.__obj_cache
+    
+  def objectsPersistencyStatus(self, objects):
+    obj_cache = self.__obj_cache
+    return [obj in obj_cache for obj in objects]
     
   
   # do the garbage collection on objects with refcounter of zero    
   # we need a write transaction to do this, as we will change the database!  
-  def __collect(self, cursor,  refcount_table):
+  def __collect(self, cursor, decode_and_decrease_refcount):
     # local reference to the non-collected objects with refcount of 0
     to_collect = self.__to_collect
-    
-    # this msgpack decoder function will decrement the refcount of each object it encounteres
-    # we use it to decrease the dependency on contained objects
-    def decode_and_decrease_refcount(code, oid):
-      if code == 1: 
-        refcount = refcount_table.pop(oid, 1)
-        # case 1 - refcount == 1, then we release the object
-        if refcount == 1:
-          # we must notify the collector that this object is being released
-          to_collect.add(oid)
-        else:
-          # decrease it by one
-          refcount -= 1
-          if refcount > 1: # we need to write this back
-            refcount_table[oid] = refcount
-          
-      else: 
-        raise ValueError("Unknown extended type: %s" % code)
-
+    # the objects we have deleted
+    collected = set()
 
+    # this is a batched mark and sweep: we fetch the data of all released objects in one go, 
+    # delete them and release everything they refer to, until there is nothing left
     while len(to_collect)>0:
-      # get the next id to be collected
-      oid = to_collect.pop()
+      frontier = list(to_collect)
+      to_collect.clear()
+      collected.update(frontier)
       
-      data = cursor.execute('select data from objects where oid = ?', (oid,)).fetchone()
-      cursor.execute('delete from objects where oid = ?', (oid,))
+      for placeholders, chunk in iter_sql_lists(frontier):
+        # (the chunk is padded with the last oid, which the 'in' lists ignore)
+        rows = cursor.execute(sql_select_data_for_oids % placeholders, chunk).fetchall()
+        cursor.execute(sql_delete_objects % placeholders, chunk)
+        cursor.execute(sql_delete_index_for_oids % placeholders, chunk)
+        cursor.execute(sql_delete_refcounts % placeholders, chunk)
       
-      # and make sure the refcount of its dependences is decreased
-      if data is not None:
-        msgpack.unpackb(data[0], ext_hook = decode_and_decrease_refcount)
+        # and make sure the refcount of its dependences is decreased
+        for data, in rows:
+          if data is not None:
+            msgpack.unpackb(data, ext_hook = decode_and_decrease_refcount)
         
-      
-      # remove the item from cache 
+      # remove the items from cache 
       # the reference to the object might still live, but it will be basically treated as a newly created (dangling) object
-      wref = self.__oid_to_wref.pop(oid, None)
-      if wref is not None:
-        del self.__obj_cache[wref]
-        
+      for oid in frontier:
+        self.__data_cache.discard(oid)
+        wref = self.__oid_to_wref.pop(oid, None)
+        if wref is not None:
+          del self.__obj_cache[wref]
+          
+    return collected
         
+  def collectGarbage(self):
+    # collect the objects that were released by the commits in the deferred mode
+    self.__to_collect.update(oid for oid, in self.__cursor.execute(sql_select_released))
+    
+    if len(self.__to_collect) > 0:
+      self.__commit({}, {}, None, True)
+      
+    self.__garbage_pending = False
 
+  def commitChanges(self, objects, root_items, changes = None): 
+    # objects maps the objects to their new data, changes (optional) maps them to the changed attributes
+    # only the references in the changed attributes of stored objects have to be recounted
+    #
+    # with the deferred collection, the released objects stay in the database (with refcount of 0)
+    # until collectGarbage() is called, which happens on close or before the next class scan
+    self.__commit(objects, root_items, changes, self.__policy.collect == 'commit')
+    
   # this is where the magic happens
-  def commitChanges(self, objects, root_items): 
+  def __commit(self, objects, root_items, changes, collect): 
+    if self.__readonly:
+      # nothing to do
+      if len(objects) == 0 and len(root_items) == 0:
+        return
+      raise RuntimeError('The database %s is opened read-only' % self.__path)
+    
     # this will record all new objects in case we need to invalidate the cache on abort
     new_objects = []   
+    # the (id, name) of the classes registered by this commit
+    new_classes = []
+    # the (code, pair) of the pairs interned by this commit
+    new_interned = []
+    # the attribute index entries of the committed objects, and the stored objects whose entries they replace
+    indexed_attributes = self.__indexed_attributes
+    index_entries = []
+    reindexed_oids = []
+    new_index_keys = []
     committed_objects = set()
+    # the (oid, class, data) rows of the new objects, inserted in one go
+    new_rows = []
+    # the oids of the new objects are assigned from the sequence, so that we can 
+    # encode an object before it is inserted
+    first_oid = self.__next_oid
     
     cursor = self.__cursor     
     
+    # the commit is coalesced with the earlier ones if their transaction is still open, 
+    # a savepoint allows us to roll back just this commit 
+    group = self.__commit_group
+    
     # --- commit is starting!
     # we do it in a try-except block so we can rollback the cache and the db state if somethign go wrong
     try:
-      # 1 read in the refcount table
-      refcount_table = cursor.execute('select refcounts from globals').fetchone()[0]
-      if refcount_table is None:
-        refcount_table = {}
-      else:
-        refcount_table = msgpack.unpackb(refcount_table)
-        
+      cursor.execute('begin' if group is None else 'savepoint logical_commit')
+      
+      # 1 the refcounts of the objects touched by this commit (oid -> count)
+      # the counts are read in lazily and written back at the end of the commit
+      refcount_table = {}
+      
+      def get_refcount(oid):
+        refcount = refcount_table.get(oid, None)
+        if refcount is None:
+          refcount = refcount_table[oid] = self.__getRefcount(cursor, oid)
+        return refcount
         
       # this msgpack decoder function will decrement the refcount of each object it encounteres
       # we use it to decrease the dependency on contained objects
       def decode_and_decrease_refcount(code, oid):
         if code == 1: 
           oid = int_packer.unpack(oid)[0]
-          refcount = refcount_table.pop(oid, 1)
-          # case 1 - refcount == 1, then we release the object
-          if refcount == 1:
+          refcount = get_refcount(oid) - 1
+          refcount_table[oid] = refcount
+          # case 1 - refcount dropped to 0, then we release the object
+          if refcount == 0:
             # we must notify the collector that this object is being released
             self.__to_collect.add(oid)
-
-          else:
-            # decrease it by one
-            refcount -= 1
-            if refcount > 1: # we need to write this back
-              refcount_table[oid] = refcount
-            # make sure its not collected!
-            #self.__to_collect.discard(oid)
-          
         else: 
           raise ValueError("Unknown extended type: %s" % code)
 
@@ -361,20 +1255,26 @@ class SQLStorageEngine(object):
       def encode_and_increase_refcount(obj):
 
         
-        cache_entry = self.__obj_cache.get(obj, None)
-        if cache_entry is None:
+        oid = self.__obj_cache.get(obj, None)
+        if oid is None:
           # we need to create a new object
           
           # 1. get the class_i
-          try:
-            classname = obj.__class__.__name__
-            classname_i = self.__classnames.index(classname)
-          except ValueError:
+          classname = obj.__class__.__name__
+          classname_i = self.__class_ids.get(classname, None)
+          if classname_i is None:
             if not self.isClassAccepted(obj.__class__):
               raise ValueError('Class %s is not persistent and cannot be encoded!' % obj.__class__)
             
+            # register the class
             classname_i = len(self.__classnames)
-            self.__classnames.append(classname)
+            self.__classnames[classname_i] = classname
+            self.__class_ids[classname] = classname_i
+            new_classes.append((classname_i, classname))
+            
+            # and its layout
+            if classname in self.__new_layouts:
+              self.__setLayout(cursor, classname_i, self.__new_layouts[classname], new_interned)
         
           # get the object data
           # its either in the commit record
@@ -383,33 +1283,32 @@ class SQLStorageEngine(object):
           if data is None:
             data = self.getDataForPersistenceCandidate(obj)
           data = dict(data)  
-          # ok, this is inelegant, but for now it will suffice
-          # we add the object twice to the table - because we need to know the oid
-          cursor.execute('insert into objects values(null, ?, null)', (classname_i,))
-          oid = cursor.lastrowid
+          # take the next oid from the sequence
+          oid = self.__next_oid
+          self.__next_oid = oid + 1
            
             
           # add it to the cache
           # we add it to the cache first to deal with circular dependencies
           wref = WeakKey(obj, self.__remove_wref)
         
-          self.__obj_cache[wref] = ObjCacheEntry(oid, data)
+          self.__obj_cache[wref] = oid
           self.__oid_to_wref[oid] = wref
+          self.__data_cache[oid] = data
         
-          # pack the data and put it into the database   
-          packed_data = buffer(msgpack.packb(data, default = encode_and_increase_refcount))
+          # pack the data, it will be put into the database with the other new objects
+          packed_data = buffer(msgpack.packb(self.__compactRecord(classname_i, data, new_interned), default = encode_and_increase_refcount))
           
-          cursor.execute('update objects set data = ? where oid = ?', (packed_data, oid))
+          new_rows.append((oid, classname_i, packed_data))
+          index_entries.extend((oid, classname_i, self.__indexKeyCode(key, new_index_keys), value) for key, value in iter_index_entries(data, indexed_attributes))
           
           committed_objects.add(obj)
         
           # and mark it as a new object - we need it to rollback the cache
           new_objects.append((oid, wref))
         else:
-          oid = cache_entry.oid
-        
           # increase the refcounter
-          refcount_table[oid] = refcount_table.get(oid, 1) + 1
+          refcount_table[oid] = get_refcount(oid) + 1
           self.__to_collect.discard(oid)
 
         return tuple.__new__(ExtType, (1, int_packer.pack(oid)))
@@ -423,31 +1322,45 @@ class SQLStorageEngine(object):
           
         # ok, the idea is - if the object is not yet persistent, we don't update it
         # because if its not persistent, its refcount is 0
-        cache_entry = self.__obj_cache.get(obj, None)
-        if cache_entry is None: 
+        oid = self.__obj_cache.get(obj, None)
+        if oid is None: 
           continue
         
-
-        oid = cache_entry[0]
         
-        # the data has changed - decrement the refcounts of all dependent objects
-        old = cursor.execute('select data from objects where oid = ?', (oid,)).fetchone()
-        if old is not None:
-          msgpack.unpackb(old[0], ext_hook = decode_and_decrease_refcount)
+        old = cursor.execute(sql_select_object_data, (oid,)).fetchone()
+        changed_attributes = None if changes is None else changes.get(obj, None)
         
-        # set the new data and cache entry
+        # set the new cache entry
          # print 'SQL COMMITS', obj, data
-        self.__obj_cache[obj] = ObjCacheEntry(oid, dict(data))
+        self.__data_cache[oid] = dict(data)
         #print 'CACHE ENTRY IS', self.__obj_cache[obj]
-        data = buffer(msgpack.packb(data, default = encode_and_increase_refcount))
         
-        def decode(code, oid):
-          if code == 1: 
-            oid = int_packer.unpack(oid)[0]
-          return oid
+        # update the attribute index (if the indexed attributes were changed)
+        if len(indexed_attributes) > 0 and (changed_attributes is None or not indexed_attributes.isdisjoint(changed_attributes)):
+          classname_i = self.__class_ids[obj.__class__.__name__]
+          reindexed_oids.append(oid)
+          index_entries.extend((oid, classname_i, self.__indexKeyCode(key, new_index_keys), value) for key, value in iter_index_entries(data, indexed_attributes))
         
+        if changed_attributes is None:
+          # the data has changed - decrement the refcounts of all dependent objects
+          if old is not None:
+            msgpack.unpackb(old[0], ext_hook = decode_and_decrease_refcount)
+        else:
+          # only some attributes have changed - decrement the refcounts of the objects they referred to
+          # the other attributes are copied over from the stored data as they are, with references 
+          # left encoded, so their refcounts stay untouched
+          stored = {} if old is None else self.__expandRecord(msgpack.unpackb(old[0], encoding = 'utf-8'))
+          for attr in changed_attributes:
+            for ref in iter_references(stored.pop(attr, None)):
+              decode_and_decrease_refcount(ref.code, ref.data)
+            if attr in data:
+              stored[attr] = data[attr]
+          data = stored
+        
+        # pack the new data
+        data = buffer(msgpack.packb(self.__compactRecord(self.__class_ids[obj.__class__.__name__], data, new_interned), default = encode_and_increase_refcount))
         
-        cursor.execute('update objects set data = ? where oid = ?', (data, oid))
+        cursor.execute(sql_update_object_data, (data, oid))
         committed_objects.add(obj)
         
         
@@ -462,49 +1375,95 @@ class SQLStorageEngine(object):
         
         
         # make sure the old data is released
-        old = cursor.execute('select value from root where key = ?', (key,)).fetchone()
+        old = cursor.execute(sql_select_root_value, (key,)).fetchone()
         if old is not None:
           msgpack.unpackb(old[0], ext_hook = decode_and_decrease_refcount)
-          cursor.execute('delete from root where key = ?', (key,))    
+          cursor.execute(sql_delete_root_item, (key,))    
 
         # make sure the new data is retained
 
         
         if value is not None:
           value = buffer(msgpack.packb(value, default = encode_and_increase_refcount))
-          cursor.execute('insert into root values(?, ?)', (key, value))
+          cursor.execute(sql_insert_root_item, (key, value))
         
           
 
         
-      # step 3 - collect the garbage
-      self.__collect(cursor, refcount_table)      
-      
-      # sync the refcount table
-      if len(refcount_table)>0:
-        cursor.execute('update globals set refcounts = ?', (buffer(msgpack.packb(refcount_table)), ))
+      # insert the new classes and objects and advance the sequence
+      if len(new_classes) > 0:
+        cursor.executemany(sql_insert_class, new_classes)
+      if len(new_rows) > 0:
+        cursor.executemany(sql_insert_object, new_rows)
+        cursor.execute('update globals set next_oid = ?', (self.__next_oid, ))
+        
+      # insert the new interned pairs
+      cursor.executemany(sql_insert_interned, new_interned)
+        
+      # replace the attribute index entries
+      cursor.executemany(sql_insert_index_key, new_index_keys)
+      cursor.executemany(sql_delete_index_entries, ((oid, ) for oid in reindexed_oids))
+      cursor.executemany(sql_insert_index_entry, index_entries)
+        
+      # step 3 - collect the garbage (or leave it for later)
+      if collect:
+        collected = self.__collect(cursor, decode_and_decrease_refcount)      
       else:
-        cursor.execute('update globals set refcounts = null')
-
+        collected = ()
+        if len(self.__to_collect) > 0:
+          self.__garbage_pending = True
+          self.__to_collect.clear()
       
-      # and the classnames!
-      cursor.execute('update globals set classnames = ?', (buffer(msgpack.packb(self.__classnames)), ))
+      # sync the refcounts of the touched objects
+      # objects with refcount of 1 (or collected ones) do not need an entry
+      cursor.executemany(sql_delete_refcount, ((oid, ) for oid, refcount in refcount_table.iteritems() if refcount == 1 or oid in collected))
+      cursor.executemany(sql_replace_refcount, ((oid, refcount) for oid, refcount in refcount_table.iteritems() if refcount != 1 and oid not in collected))
 
-      # commit the transaction!
-      self.__connection.commit()
-      self.__connection.execute('pragma wal_checkpoint(truncate);')
+      # the commit is done (it is written by flush())
+      if group is not None:
+        cursor.execute('release logical_commit')
     except:
-      self.__connection.rollback()
+      if group is None:
+        self.__connection.rollback()
+      else:
+        # the coalesced commits stay
+        cursor.execute('rollback to logical_commit')
+        cursor.execute('release logical_commit')
+      
+      # forget the objects that were scheduled for collection
+      self.__to_collect.clear()
+      
+      # and the oids and classes we gave out
+      self.__next_oid = first_oid
+      self.__forgetRegistrations(new_classes, new_interned, new_index_keys)
+      
+      # the cached data of the changed objects is not valid anymore, it will be read in again
+      for obj in objects:
+        oid = self.__obj_cache.get(obj, None)
+        if oid is not None:
+          self.__data_cache.discard(oid)
       
       # restore the cache
       for oid, wref in new_objects:
         del self.__obj_cache[wref]
         del self.__oid_to_wref[oid]
+        self.__data_cache.discard(oid)
         
 
       self.debug()
       raise
       
+    # coalesce the commit with the others in the window, or write it
+    if group is None:
+      group = self.__commit_group = CommitGroup(time.time(), first_oid, [], [], [])
+    group.classes.extend(new_classes)
+    group.interned.extend(new_interned)
+    group.index_keys.extend(new_index_keys)
+    self.__commits += 1
+    
+    if time.time() - group.started >= self.__policy.commit_window:
+      self.flush()
+      
       
     
     
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright 2018 Taras Zakharko (taras.zakharko)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+  Storage benchmarks.
+
+  Usage:
+    python tools/benchmark_storage.py [benchmark ...]
+
+  Runs all the benchmarks if none are given
+"""
+
+import sys, os, time, tempfile, shutil, gc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import persistentdb, msgpack
+from pysqlite2 import dbapi2 as sqlite3
+from observing import observers
+from model import Document
+
+# ======================  Helpers =================
+def make_document(path, spans, tokens, **options):
+  """ Create a document with the given number of spans and tokens per span """
+  document = Document(path, **options)
+
+  trn = document.database.transaction()
+  with trn:
+    for i in xrange(spans):
+      span = Document.persistenceSchema.classes.Span(externalID = i, info = {'translation' : u'translation %d' % i})
+      for j in xrange(tokens):
+        span.addToken(Document.persistenceSchema.classes.Token(u'token%d' % j))
+      document.addSpan(span)
+  trn.commit()
+
+  return document
+
+def remove_document(path):
+  for suffix in ('', '-wal', '-shm'):
+    try: os.remove(path + suffix)
+    except OSError: pass
+
+def timed(f, *args, **kwargs):
+  """ Returns the time f took to run (in seconds) and its result """
+  gc.collect()
+  t0 = time.time()
+  result = f(*args, **kwargs)
+  return time.time() - t0, result
+
+
+# ======================  Benchmarks =================
+def benchmark_policies(spans = 200, tokens = 20, commits = 200):
+  """ Single variable commits per second and the time to open a document under each storage policy """
+  directory = tempfile.mkdtemp()
+
+  try:
+    for name in ('SafePolicy', 'InteractivePolicy', 'GroupCommitPolicy', 'BulkPolicy'):
+      policy = getattr(persistentdb, name)
+      path = os.path.join(directory, name + '.anno')
+
+      document = make_document(path, spans, tokens, policy = policy)
+      tokens_to_edit = [token for span in document.spans for token in span.tokens][:commits]
+
+      # commit variable changes one by one, just like the annotator does
+      def edit(tokens_to_edit):
+        for i, token in enumerate(tokens_to_edit):
+          trn = document.database.transaction()
+          with trn:
+            token.variables['PoS'] = 'Noun' if i % 2 == 0 else 'Verb'
+          trn.commit()
+        # the coalesced commits are only done when they are written
+        document.database.flush()
+
+      edit_time, _ = timed(edit, tokens_to_edit)
+
+      del tokens_to_edit
+      document.close()
+
+      open_time, document = timed(Document, path, policy = policy)
+      document.close()
+
+      print '%-18s %8.1f commits/s %8.3f s to open' % (name, commits/edit_time, open_time)
+  finally:
+    shutil.rmtree(directory)
+
+def benchmark_loading(spans = 5000, tokens = 19):
+  """ Time per object to load a document of 100k objects lazily, with prefetching and span by span """
+  directory = tempfile.mkdtemp()
+
+  try:
+    path = os.path.join(directory, 'loading.anno')
+    make_document(path, spans, tokens, policy = persistentdb.BulkPolicy).close()
+
+    # touch every object, which loads it
+    def walk(database, materialize = False):
+      count = 0
+      for span in database.root['spans']:
+        span.externalID
+        if materialize:
+          database.materialize(span.tokens)
+        for token in span.tokens:
+          token.transcription
+          count += 1
+        count += 1
+      return count
+
+    for name in ('lazy', 'prefetched', 'materialized'):
+      # we open the database directly, as the document touches all the objects when it is opened
+      database = persistentdb.DB(path, persistentdb.SQLStorageEngine, schema = Document.persistenceSchema)
+
+      def load():
+        classes = Document.persistenceSchema.classes
+        prefetched = database.prefetch(classes = (classes.Span, classes.Token)) if name == 'prefetched' else None
+        return walk(database, name == 'materialized')
+
+      load_time, count = timed(load)
+      database.close()
+
+      print '%-18s %8d objects %8.2f us/object' % (name, count, load_time*1e6/count)
+  finally:
+    shutil.rmtree(directory)
+
+def benchmark_decoding(spans = 2500, tokens = 20):
+  """ Time to decode, prefetch and read a document of 50k tokens: row by row or with a shared unpacker, eagerly or lazily """
+  directory = tempfile.mkdtemp()
+
+  try:
+    path = os.path.join(directory, 'decoding.anno')
+    make_document(path, spans, tokens, policy = persistentdb.BulkPolicy).close()
+    classes = Document.persistenceSchema.classes
+
+    # the decoding alone: msgpack.unpackb for every row (as the engine did before) and one shared 
+    # Unpacker (as the engine does now), the references are decoded to their oids
+    connection = sqlite3.connect(path)
+    rows = connection.execute('select data from objects where data is not null').fetchall()
+    connection.close()
+
+    def decode_reference(code, data):
+      return data
+
+    def unpack_rows():
+      return [msgpack.unpackb(data, encoding = 'utf-8', ext_hook = decode_reference) for data, in rows]
+
+    def unpack_shared():
+      unpacker = msgpack.Unpacker(encoding = 'utf-8', ext_hook = decode_reference)
+      decoded = []
+      for data, in rows:
+        unpacker.feed(data)
+        decoded.append(unpacker.unpack())
+      return decoded
+
+    for name, decode in (('unpackb per row', unpack_rows), ('shared unpacker', unpack_shared)):
+      decode_time, decoded = timed(decode)
+      print '%-18s %8.3f s to decode %d objects' % (name, decode_time, len(decoded))
+
+    for lazy_decode in (False, True):
+      database = persistentdb.DB(path, persistentdb.SQLStorageEngine, schema = Document.persistenceSchema, lazy_decode = lazy_decode)
+
+      prefetch_time, prefetched = timed(database.prefetch, classes = (classes.Span, classes.Token))
+
+      def read():
+        return [token.transcription for span in database.root['spans'] for token in span.tokens]
+
+      read_time, transcriptions = timed(read)
+
+      del prefetched
+      database.close()
+
+      print '%-18s %8.3f s to prefetch %8.3f s to read %d tokens' % ('lazy' if lazy_decode else 'eager', prefetch_time, read_time, len(transcriptions))
+  finally:
+    shutil.rmtree(directory)
+
+def benchmark_layout(spans = 2500, tokens = 20, variables = 6):
+  """ File size and loading time of a document of 50k annotated tokens, with and without the compact token records """
+  directory = tempfile.mkdtemp()
+
+  # some variable values for the tokens
+  values = []
+  for decl in Document.variableDefinitions:
+    if decl.key not in dict(values):
+      values.append((decl.key, decl.value))
+  values = dict(values[:variables])
+
+  try:
+    for name, layouts in (('dictionaries', {}), ('records', Document.recordLayouts)):
+      path = os.path.join(directory, name + '.anno')
+      document = make_document(path, spans, tokens, policy = persistentdb.BulkPolicy, layouts = layouts)
+
+      trn = document.database.transaction()
+      with trn:
+        for span in document.spans:
+          for token in span.tokens:
+            token._variables = dict(values)
+            token.gloss = u'gloss'
+      trn.commit()
+      document.close()
+
+      size = os.path.getsize(path)
+
+      database = persistentdb.DB(path, persistentdb.SQLStorageEngine, schema = Document.persistenceSchema)
+      classes = Document.persistenceSchema.classes
+
+      def load():
+        prefetched = database.prefetch(classes = (classes.Span, classes.Token))
+        return [getattr(token, '_variables', None) for span in database.root['spans'] for token in span.tokens]
+
+      load_time, _ = timed(load)
+      database.close()
+
+      print '%-18s %8.1f MB %8.3f s to load' % (name, size/1024.0/1024.0, load_time)
+  finally:
+    shutil.rmtree(directory)
+
+def benchmark_notifications(spans = 500, tokens = 20):
+  """ Time per change of 10k tokens in a transaction and per rolled back change, with and without observers on the tokens """
+  for name in ('unobserved', 'observed'):
+    document = make_document(None, spans, tokens, engine = persistentdb.MemoryStorageEngine)
+    all_tokens = [token for span in document.spans for token in span.tokens]
+
+    # observe every token, just like the views do
+    def observer(obj, context):
+      pass
+    if name == 'observed':
+      for token in all_tokens:
+        observers(token, 'transcription').after += observer
+
+    trn = document.database.transaction()
+    def change():
+      with trn:
+        for token in all_tokens:
+          token.transcription = u'changed'
+
+    change_time, _ = timed(change)
+    abort_time, _ = timed(trn.abort)
+    document.close()
+
+    print '%-18s %8.2f us/change %8.2f us/rolled back change' % (name, change_time*1e6/len(all_tokens), abort_time*1e6/len(all_tokens))
+
+def benchmark_rollback(spans = 500, tokens = 20):
+  """ Time and observer notifications to roll back a failed import that changed 10k tokens, attribute by attribute and coalesced """
+  classes = Document.persistenceSchema.classes
+
+  for name, coalesce in (('per attribute', False), ('coalesced', True)):
+    document = make_document(None, spans, tokens, engine = persistentdb.MemoryStorageEngine)
+    all_tokens = [token for span in document.spans for token in span.tokens]
+
+    # observe the tokens and the token lists of the spans, just like the views do
+    notifications = [0]
+    def observer(obj, context):
+      notifications[0] += 1
+    for span in document.spans:
+      observers(span, 'tokens').after += observer
+    for token in all_tokens:
+      observers(token, 'transcription').after += observer
+      observers(token, '__dict__').after += observer
+
+    # the import changes every token and adds one to every span
+    trn = document.database.transaction()
+    with trn:
+      for token in all_tokens:
+        token.transcription = u'imported'
+        token.gloss = u'imported'
+      for span in document.spans:
+        span.addToken(classes.Token(u'imported'))
+
+    notifications[0] = 0
+    abort_time, _ = timed(trn.abort, coalesce)
+    document.close()
+
+    print '%-18s %8.3f s %8d notifications' % (name, abort_time, notifications[0])
+
+
+benchmarks = {
+  'policies' : benchmark_policies,
+  'loading'  : benchmark_loading,
+  'decoding' : benchmark_decoding,
+  'layout'   : benchmark_layout,
+  'notifications' : benchmark_notifications,
+  'rollback' : benchmark_rollback
+}
+
+if __name__ == '__main__':
+  for name in (sys.argv[1:] or sorted(benchmarks)):
+    print '--- %s: %s' % (name, benchmarks[name].__doc__.strip())
+    benchmarks[name]()
@@ -0,0 +1,594 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright 2018 Taras Zakharko (taras.zakharko)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+  Conformance checks for the storage engines (see persistentdb/storage.py).
+
+  Usage:
+    python tools/check_storage_engines.py
+
+  Runs the checks on every engine, which must pass all of them (the checks of the features 
+  an engine doesn't offer are skipped). A new engine can be checked with check_engine(engine, make_path)
+"""
+
+import sys, os, tempfile, shutil, itertools, traceback, functools, gc
+from collections import namedtuple
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import persistentdb
+from pysqlite2 import dbapi2 as sqlite3
+
+# ======================  The schema of the checks =================
+schema = persistentdb.PersistenceSchema()
+
+@schema.Persistent
+class Item(object):
+  def __init__(self, name, children = ()):
+    self.name = name
+    self.children = list(children)
+
+class NotPersistent(object):
+  pass
+
+# ======================  Helpers =================
+def commit(database, f):
+  """ Run f in a transaction and commit it """
+  trn = database.transaction()
+  with trn:
+    f()
+  trn.commit()
+
+def names(objects):
+  return sorted(obj.name for obj in objects)
+
+# the engine, path and options of the database of a check
+Setup = namedtuple('Setup', 'engine,path,options')
+
+class Unsupported(Exception):
+  """ raised by a check if the engine doesn't offer the feature it checks """
+
+def sqlite_file(setup):
+  """ a connection to the file of the database, for the checks of what the SQL engines store """
+  if not issubclass(setup.engine, persistentdb.SQLStorageEngine):
+    raise Unsupported()
+  return sqlite3.connect(setup.path)
+
+def reopen(database, setup, **options):
+  """ close the database and open it again with more options (the engines that don't keep the data start empty) """
+  database.close()
+  return persistentdb.DB(setup.path, setup.engine, schema = schema, **dict(setup.options, **options))
+
+def forget_instances():
+  """ drop the unreferenced instances, so that the objects are read from the storage again """
+  gc.collect()
+
+# ======================  Checks =================
+# every check gets a new database and fails with an exception
+checks = []
+
+def check(f):
+  checks.append(functools.wraps(f)(lambda database, setup: f(database)))
+  return f
+
+def check_setup(f):
+  """ a check that gets the Setup of the database as well """
+  checks.append(f)
+  return f
+
+@check
+def check_root_items(database):
+  """ root items are stored, changed, deleted and returned as copies """
+  def set_items():
+    database.root['value'] = [1, 2.5, u'text', {'key' : [True, None]}]
+    database.root['tuple'] = (1, 2)
+    database.root['deleted'] = 1
+  commit(database, set_items)
+
+  def delete_item():
+    del database.root['deleted']
+  commit(database, delete_item)
+
+  assert database.root['value'] == [1, 2.5, u'text', {'key' : [True, None]}]
+  assert database.root['tuple'] == [1, 2]
+  assert database.root['deleted'] is None
+  assert database.root['missing'] is None
+
+  # changing the returned value doesn't change the stored one
+  database.root['value'].append(3)
+  assert database.root['value'] == [1, 2.5, u'text', {'key' : [True, None]}]
+
+@check
+def check_new_objects(database):
+  """ new objects are stored when they are referenced, with one reference each """
+  def add_items():
+    database.root['items'] = [Item(u'a'), Item(u'b', [Item(u'c')])]
+  commit(database, add_items)
+
+  items = database.objectsByClass(Item)
+  assert names(items) == [u'a', u'b', u'c']
+  assert all(database.objectPersistencyStatus(item) for item in items)
+  assert database.getRefcountsForObjects(items).values() == [1, 1, 1]
+
+  a, b = database.root['items']
+  assert a.name == u'a' and b.children[0].name == u'c'
+
+@check
+def check_changes(database):
+  """ committed changes are stored, aborted changes are rolled back """
+  def add_item():
+    database.root['items'] = [Item(u'a')]
+  commit(database, add_item)
+  item = database.root['items'][0]
+
+  def rename():
+    item.name = u'b'
+  commit(database, rename)
+  assert names(database.objectsByClass(Item)) == [u'b']
+
+  trn = database.transaction()
+  with trn:
+    item.name = u'c'
+    item.extra = 1
+  trn.abort()
+  assert item.name == u'b' and not hasattr(item, 'extra')
+
+@check
+def check_coalesced_rollback(database):
+  """ a coalesced rollback restores the same state as one attribute by attribute """
+  def add_items():
+    database.root['items'] = [Item(u'%03d' % i) for i in xrange(150)]
+  commit(database, add_items)
+  items = database.root['items']
+
+  added = []
+  trn = database.transaction()
+  with trn:
+    for item in items:
+      item.name = u'changed'
+      item.extra = 1
+    added.append(Item(u'new'))
+    database.root['items'] = items + added
+  trn.abort(coalesce = True)
+
+  assert names(items) == [u'%03d' % i for i in xrange(150)]
+  assert not any(hasattr(item, 'extra') for item in items)
+  assert not added[0].__valid__ and len(database.root['items']) == 150
+
+@check
+def check_savepoints(database):
+  """ a savepoint rolls back only the changes made after it, a released one is committed with its transaction """
+  def add_items():
+    database.root['items'] = [Item(u'a'), Item(u'b')]
+  commit(database, add_items)
+  a, b = database.root['items']
+
+  trn = database.transaction()
+  with trn:
+    a.name = u'a1'
+
+  try:
+    database.transaction()
+  except RuntimeError:
+    pass
+  else:
+    raise AssertionError('A transaction was started within the active one')
+
+  savepoint = database.savepoint()
+  assert savepoint.nested
+  with savepoint:
+    a.name = u'a2'
+    b.name = u'b2'
+    database.root['items'] = [a, b, Item(u'c')]
+  savepoint.abort()
+  assert a.name == u'a1' and b.name == u'b' and len(database.root['items']) == 2
+
+  savepoint = database.savepoint()
+  with savepoint:
+    b.name = u'b3'
+  savepoint.commit()
+  trn.commit()
+
+  assert names(database.objectsByClass(Item)) == [u'a1', u'b3']
+
+@check
+def check_shared_references(database):
+  """ every reference to an object is counted """
+  def add_items():
+    item = Item(u'a')
+    database.root['first'] = [item]
+    database.root['second'] = [item, item]
+  commit(database, add_items)
+
+  item = database.root['first'][0]
+  assert database.getRefcountsForObjects([item])[item] == 3
+
+  def remove_reference():
+    database.root['second'] = [item]
+  commit(database, remove_reference)
+  assert database.getRefcountsForObjects([item])[item] == 2
+
+@check
+def check_release(database):
+  """ objects that are not referenced anymore are released, with the objects they refer to """
+  def add_items():
+    database.root['items'] = [Item(u'a', [Item(u'b', [Item(u'c')])]), Item(u'd')]
+  commit(database, add_items)
+  a, d = database.root['items']
+
+  def remove_item():
+    database.root['items'] = [d]
+  commit(database, remove_item)
+  database.collectGarbage()
+
+  assert names(database.objectsByClass(Item)) == [u'd']
+  assert database.getRefcountsForObjects([a])[a] == 0
+  assert not database.objectPersistencyStatus(a)
+  assert database.objectsPersistencyStatus([a, d]) == {a : False, d : True}
+
+@check_setup
+def check_collected_refcounts(database, setup):
+  """ the collection leaves no released objects behind """
+  def add_items():
+    database.root['items'] = [Item(u'a', [Item(u'b', [Item(u'c')])]), Item(u'd')]
+  commit(database, add_items)
+  d = database.root['items'][1]
+
+  def remove_item():
+    database.root['items'] = [d]
+  commit(database, remove_item)
+  database.collectGarbage()
+  database.close()
+
+  connection = sqlite_file(setup)
+  try:
+    assert connection.execute('select count(*) from refcounts where count <= 0').fetchone()[0] == 0
+    assert connection.execute('select count(*) from objects').fetchone()[0] == 1
+  finally:
+    connection.close()
+
+@check
+def check_failed_commit(database):
+  """ a commit that fails changes nothing """
+  def add_item():
+    database.root['items'] = [Item(u'a')]
+  commit(database, add_item)
+  item = database.root['items'][0]
+
+  trn = database.transaction()
+  try:
+    with trn:
+      item.name = u'b'
+      database.root['items'] = [item, Item(u'c')]
+      database.root['other'] = [NotPersistent()]
+    trn.commit()
+  except ValueError:
+    pass
+  else:
+    raise AssertionError('Objects of classes that are not persistent were committed')
+
+  assert item.name == u'a'
+  assert len(database.root['items']) == 1 and database.root['other'] is None
+  assert names(database.objectsByClass(Item)) == [u'a']
+
+@check
+def check_unreferenced_objects(database):
+  """ new objects that are not referenced when they are committed are not stored (and become invalid) """
+  items = []
+  def add_items():
+    items.extend([Item(u'a'), Item(u'b')])
+    database.root['items'] = items[1:]
+  commit(database, add_items)
+
+  assert not items[0].__valid__ and items[1].__valid__
+  assert names(database.objectsByClass(Item)) == [u'b']
+
+@check
+def check_class_iteration(database):
+  """ the class iteration returns the objects of the class """
+  def add_items():
+    database.root['items'] = [Item(u'%03d' % i) for i in xrange(250)]
+  commit(database, add_items)
+
+  assert names(database.iterObjectsByClass(Item, 16)) == names(database.objectsByClass(Item))
+  assert len(database.objectsByClass(Item)) == 250
+
+@check
+def check_conditions(database):
+  """ the condition queries return the matching objects """
+  def add_items():
+    database.root['items'] = [Item(u'a'), Item(u'b'), Item(u'b')]
+  commit(database, add_items)
+
+  assert names(database.objectsByCondition({'name' : u'b'}, Item)) == [u'b', u'b']
+  assert names(database.objectsByCondition(persistentdb.Exists('children'), Item)) == [u'a', u'b', u'b']
+
+# the checks of the features that are optional for the engines (see storage.StorageEngine)
+@check_setup
+def check_index_queries(database, setup):
+  """ the condition queries return the same objects with the attribute index as without it """
+  database = reopen(database, setup, indexed_attributes = ('name', 'tags'))
+  try:
+    def add_items():
+      items = [Item(u'%03d' % (i % 50)) for i in xrange(200)]
+      for i, item in enumerate(items):
+        if i % 3 > 0:
+          item.tags = {'color' : (u'red', u'green')[i % 2], 'size' : i % 7}
+        elif i % 2 > 0:
+          item.tags = {'color' : [u'not', u'indexed']}
+      database.root['items'] = items
+    commit(database, add_items)
+
+    conditions = [
+      persistentdb.Equals('name', u'007'),
+      persistentdb.Equals('name', u'missing'),
+      persistentdb.In('name', [u'%03d' % i for i in xrange(0, 60, 3)]),
+      # too many values for one statement
+      persistentdb.In('name', [u'%03d' % i for i in xrange(0, 3000, 3)]),
+      persistentdb.In('name', [u'%03d' % i for i in xrange(600)]) & persistentdb.In('tags.size', range(600)),
+      persistentdb.Equals('tags.color', u'red') & persistentdb.Equals('tags.size', 3),
+      persistentdb.Exists('tags.color'),
+      persistentdb.Exists('tags') & ~persistentdb.Equals('tags.color', u'red'),
+      persistentdb.Equals('tags.missing', 1)
+    ]
+
+    def check_conditions():
+      items = database.objectsByClass(Item)
+      for condition in conditions:
+        assert database.objectsByCondition(condition, Item) == set(item for item in items if condition.matches(item)), condition
+
+    check_conditions()
+
+    # the index follows the commits, the changes of an active transaction are seen as well
+    items = database.root['items']
+    def change_items():
+      items[0].name = u'007'
+      del items[1].tags
+      items[2].tags = {'size' : 3}
+    commit(database, change_items)
+    check_conditions()
+
+    trn = database.transaction()
+    with trn:
+      items[3].name = u'007'
+      items[4].tags = {'color' : u'red', 'size' : 3}
+      check_conditions()
+    trn.abort()
+    check_conditions()
+  finally:
+    database.close()
+
+@check_setup
+def check_readonly(database, setup):
+  """ a read-only database keeps its snapshot until it is refreshed and can't commit """
+  database = reopen(database, setup, shared = True)
+  reader = None
+  try:
+    def add_items():
+      database.root['items'] = [Item(u'a'), Item(u'b')]
+    commit(database, add_items)
+    # (the readers only see the written commits, see StoragePolicy.commit_window)
+    database.flush()
+    a, b = database.root['items']
+
+    reader = persistentdb.DB(setup.path, setup.engine, schema = schema, **dict(setup.options, readonly = True))
+    if not reader.readonly:
+      raise Unsupported()
+    assert names(reader.objectsByClass(Item)) == [u'a', u'b']
+
+    trn = reader.transaction()
+    try:
+      with trn:
+        reader.root['items'] = []
+      trn.commit()
+    except RuntimeError:
+      pass
+    else:
+      raise AssertionError('A read-only database committed')
+    assert len(reader.root['items']) == 2
+
+    # the released objects are not seen, even if they are not collected yet
+    def change_items():
+      a.name = u'c'
+      database.root['items'] = [a]
+    commit(database, change_items)
+    database.flush()
+    assert names(reader.objectsByClass(Item)) == [u'a', u'b']
+
+    reader.refresh()
+    assert names(reader.objectsByClass(Item)) == [u'c']
+    assert names(reader.root['items']) == [u'c']
+  finally:
+    if reader is not None:
+      reader.close()
+    database.close()
+
+@check_setup
+def check_snapshot(database, setup):
+  """ a snapshot is a complete copy, one that is interrupted by a commit has the state after it """
+  def add_items():
+    database.root['items'] = [Item(u'a', [Item(u'b')]), Item(u'c')]
+  commit(database, add_items)
+  a, c = database.root['items']
+
+  copies = [setup.path + '.copy', setup.path + '.interrupted']
+  try:
+    database.snapshot(copies[0])
+  except NotImplementedError:
+    raise Unsupported()
+
+  steps = database.iterSnapshot(copies[1], batch_size = 1)
+  steps.next()
+  def change_items():
+    a.name = u'd'
+    database.root['items'] = [a]
+  commit(database, change_items)
+  for fraction in steps:
+    pass
+  assert fraction == 1.0
+
+  for path, expected in zip(copies, ([u'a', u'b', u'c'], [u'b', u'd'])):
+    copy = persistentdb.DB(path, setup.engine, schema = schema, **setup.options)
+    try:
+      copy.collectGarbage()
+      assert names(copy.objectsByClass(Item)) == expected
+      assert copy.getRefcountsForObjects(copy.objectsByClass(Item)).values() == [1]*len(expected)
+    finally:
+      copy.close()
+
+@check_setup
+def check_record_layouts(database, setup):
+  """ the objects of a class with a record layout are read back as they were stored """
+  layout = persistentdb.RecordLayout(('name', 'children', 'tags'), ('tags', ), [('color', u'red')])
+  database = reopen(database, setup, layouts = {'Item' : layout}, cache_size = 1)
+  try:
+    # interned items, items that can't be interned (not hashable or references), no items
+    values = [{'color' : u'red', 'size' : 1}, {'color' : [u'a', u'b']}, None, {}]
+    def add_items():
+      values[2] = {'ref' : Item(u'other'), 'size' : 1}
+      items = [Item(u'%d' % i) for i in xrange(len(values))]
+      for item, value in zip(items, values):
+        item.tags = dict(value)
+      items[0].extra = 1
+      database.root['items'] = items + [values[2]['ref']]
+    commit(database, add_items)
+    other = values[2]['ref']
+
+    def check_items():
+      forget_instances()
+      items = database.root['items']
+      assert [item.tags for item in items[:-1]] == values
+      assert items[0].extra == 1 and not hasattr(items[1], 'extra')
+      assert items[-1] is other and not hasattr(other, 'tags')
+
+    check_items()
+
+    items = database.root['items']
+    def change_items():
+      items[0].tags = {'color' : u'green', 'size' : 1}
+      del items[0].extra
+      items[1].tags = {'color' : u'red'}
+    commit(database, change_items)
+    values[0:2] = [{'color' : u'green', 'size' : 1}, {'color' : u'red'}]
+    items = None
+
+    forget_instances()
+    items = database.root['items']
+    assert [item.tags for item in items[:-1]] == values
+    assert not hasattr(items[0], 'extra')
+  finally:
+    database.close()
+
+@check
+def check_prefetch(database):
+  """ prefetching returns the loaded objects and doesn't change the objects of an active transaction """
+  def add_items():
+    database.root['items'] = [Item(u'a', [Item(u'b')]), Item(u'c')]
+  commit(database, add_items)
+  forget_instances()
+
+  # the engines that don't prefetch return nothing
+  prefetched = database.prefetch(classes = (Item, ))
+  assert len(prefetched) == 0 or names(prefetched) == [u'a', u'b', u'c']
+  a, c = database.root['items']
+  prefetched = database.prefetch(objects = [a, c])
+  assert len(prefetched) == 0 or names(prefetched) == [u'a', u'c']
+
+  trn = database.transaction()
+  with trn:
+    a.name = u'd'
+    database.prefetch(classes = (Item, ), objects = [a])
+    assert a.name == u'd'
+  trn.abort()
+  assert a.name == u'a' and a.children[0].name == u'b'
+
+@check_setup
+def check_cache_eviction(database, setup):
+  """ the objects that are dropped from the data cache are read in again """
+  database = reopen(database, setup, cache_size = 4)
+  try:
+    def add_items():
+      database.root['items'] = [Item(u'%03d' % i, [Item(u'child')]) for i in xrange(100)]
+    commit(database, add_items)
+    expected = [u'%03d' % i for i in xrange(100)]
+
+    forget_instances()
+    for i in xrange(2):
+      items = database.root['items']
+      assert [item.name for item in items] == expected
+      assert all(item.children[0].name == u'child' for item in items)
+      items = None
+      forget_instances()
+
+    items = database.root['items']
+    def rename_items():
+      for item in items[::10]:
+        item.name = u'renamed'
+    commit(database, rename_items)
+    items = None
+    forget_instances()
+
+    expected[::10] = [u'renamed']*10
+    items = database.root['items']
+    assert [item.name for item in items] == expected
+    assert database.getRefcountsForObjects(items).values() == [1]*100
+  finally:
+    database.close()
+
+# ======================  Running the checks =================
+def check_engine(engine, make_path, **options):
+  """ Runs the checks on the engine (opened with the options), returns the names of the failed and the skipped checks """
+  failed = []
+  skipped = []
+
+  for f in checks:
+    setup = Setup(engine, make_path(), options)
+    database = persistentdb.DB(setup.path, engine, schema = schema, **options)
+    try:
+      f(database, setup)
+    except Unsupported:
+      skipped.append(f.__name__)
+    except Exception:
+      print '%s failed:' % f.__name__
+      traceback.print_exc()
+      failed.append(f.__name__)
+    finally:
+      database.close()
+
+  return failed, skipped
+
+engines = [
+  ('SQLStorageEngine',                 persistentdb.SQLStorageEngine,    {'policy' : persistentdb.InteractivePolicy}),
+  ('SQLStorageEngine (safe)',          persistentdb.SQLStorageEngine,    {'policy' : persistentdb.SafePolicy}),
+  ('SQLStorageEngine (group commits)', persistentdb.SQLStorageEngine,    {'policy' : persistentdb.GroupCommitPolicy}),
+  ('MemoryStorageEngine',              persistentdb.MemoryStorageEngine, {})
+]
+
+if __name__ == '__main__':
+  directory = tempfile.mkdtemp()
+  paths = (os.path.join(directory, '%d.db' % i) for i in itertools.count())
+
+  try:
+    failures = 0
+    for name, engine, options in engines:
+      failed, skipped = check_engine(engine, paths.next, **options)
+      print '%-34s %d of %d checks passed, %d skipped' % (name, len(checks) - len(skipped) - len(failed), len(checks) - len(skipped), len(skipped))
+      failures += len(failed)
+  finally:
+    shutil.rmtree(directory)
+
+  sys.exit(1 if failures > 0 else 0)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright 2018 Taras Zakharko (taras.zakharko)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+  Writes consistent copies of the documents in a directory.
+
+  Usage:
+    python tools/snapshot_documents.py source_directory target_directory
+
+  The documents can be open in the annotation tool (which opens them shared), the copies
+  have their last saved state (documents of older versions are copied as they are). Documents 
+  that are locked by another program are skipped
+"""
+
+import sys, os, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import persistentdb
+
+def snapshot_document(path, target_path):
+  """ Copy the document at path to target_path, from a read-only snapshot """
+  # the database file is copied directly: the document would load the objects, and the 
+  # read-only engines only open documents of the current version
+  persistentdb.backup_database(path, target_path)
+
+def snapshot_directory(directory, target_directory):
+  """ Copy all the documents in the directory, returns the number of documents that failed """
+  if not os.path.isdir(target_directory):
+    os.makedirs(target_directory)
+
+  failed = 0
+  for name in sorted(os.listdir(directory)):
+    if not name.endswith('.anno'):
+      continue
+
+    t0 = time.time()
+    try:
+      snapshot_document(os.path.join(directory, name), os.path.join(target_directory, name))
+    except Exception as e:
+      print '%-40s skipped: %s' % (name, e)
+      failed += 1
+    else:
+      print '%-40s %8.3f s' % (name, time.time() - t0)
+
+  return failed
+
+if __name__ == '__main__':
+  if len(sys.argv) != 3:
+    print __doc__
+    sys.exit(2)
+
+  sys.exit(1 if snapshot_directory(sys.argv[1], sys.argv[2]) > 0 else 0)